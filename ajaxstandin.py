@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the site's ajax.php, so RedactedAPI and the scripts can be run and benchmarked offline.
+#
+#   record:    proxy to the real site and store every response in a recording
+#   replay:    serve a recording, optionally filling the gaps with synthetic responses
+#   synthetic: serve a made-up, deterministic account
+#   check:     list the responses in a recording that hold something shaped like a passkey
+#
+# Point the scripts at it with --site http://127.0.0.1:8080/
+
+import argparse
+import http.server
+import json
+import logging
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def failure(error):
+    return 200, 'application/json', json.dumps({'status': 'failure', 'error': error}).encode()
+
+
+def success(response):
+    return 200, 'application/json', json.dumps({'status': 'success', 'response': response}).encode()
+
+
+class SyntheticSite:
+    '''
+    A made-up account seeding `seeding` FLAC torrents, `group_size` to a group, with the
+    request and notification listings on top. Everything is derived from the ids and `seed`,
+    so two instances with the same arguments answer identically.
+    '''
+    first_torrent = 1000000
+    first_group = 500000
+    request_page = 50
+    formats = [('FLAC', 'Lossless'), ('FLAC', '24bit Lossless'), ('MP3', 'V0 (VBR)'), ('MP3', '320')]
+
+    def __init__(self, seeding=2000, group_size=3, files=12, requests=5000, notifications=200, seed=0):
+        self.seeding = seeding
+        self.group_size = group_size
+        self.files = files
+        self.requests = requests
+        self.notifications = notifications
+        self.seed = seed
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def _random(self, *key):
+        return random.Random(':'.join(map(str, (self.seed,) + key)))
+
+    # The seeded torrents, newest (highest id) first like user_torrents lists them
+    def torrentids(self):
+        return range(self.first_torrent + self.seeding - 1, self.first_torrent - 1, -1)
+
+    def groupid(self, torrentid):
+        return self.first_group + (torrentid - self.first_torrent) // self.group_size
+
+    def file_list(self, torrentid):
+        rng = self._random('files', torrentid)
+        return '|||'.join(f'{n:02} - Track {n}.flac{{{{{{{rng.randrange(2 ** 24, 2 ** 26)}}}}}}}'
+                          for n in range(1, self.files + 1))
+
+    def torrent(self, torrentid, format, encoding):
+        return {'id': torrentid, 'infoHash': f'{torrentid:040X}', 'media': 'CD', 'format': format, 'encoding': encoding,
+                'remastered': False, 'remasterYear': 0, 'remasterTitle': '', 'remasterRecordLabel': '',
+                'remasterCatalogueNumber': '', 'scene': False, 'hasLog': True, 'hasCue': True, 'logScore': 100,
+                'fileCount': self.files, 'size': self.files * 2 ** 25, 'seeders': 5, 'leechers': 0, 'snatched': 10,
+                'freeTorrent': False, 'reported': False, 'time': '2020-01-01 00:00:00', 'description': '',
+                'fileList': self.file_list(torrentid), 'filePath': f'Album {torrentid}', 'userId': 1,
+                'username': 'standin', 'trumpable': False, 'lossyWebApproved': False, 'lossyMasterApproved': False}
+
+    def index(self, params):
+        return success({'username': 'standin', 'id': 1, 'authkey': '0' * 32, 'passkey': '0' * 32,
+                        'notifications': {'messages': 0, 'notifications': self.notifications},
+                        'userstats': {'uploaded': 0, 'downloaded': 0, 'ratio': 1.0, 'requiredratio': 0.6,
+                                      'class': 'Member'}})
+
+    def user(self, params):
+        return success({'username': 'standin', 'community': {'seeding': self.seeding, 'leeching': 0}})
+
+    def user_torrents(self, params):
+        if params.get('type') != 'seeding':
+            return success({params.get('type', 'seeding'): []})
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', 500))
+        page = self.torrentids()[offset:offset + limit]
+        return success({'seeding': [{'groupId': str(self.groupid(torrentid)), 'name': f'Album {torrentid}',
+                                     'torrentId': str(torrentid), 'torrentSize': str(self.files * 2 ** 25),
+                                     'artistName': 'Artist', 'artistId': '1'} for torrentid in page]})
+
+    def torrentgroup(self, params):
+        groupid = int(params.get('id', 0))
+        first = self.first_torrent + (groupid - self.first_group) * self.group_size
+        seeded = [torrentid for torrentid in range(first, first + self.group_size)
+                  if self.first_torrent <= torrentid < self.first_torrent + self.seeding]
+        if not seeded:
+            return failure('bad id parameter')
+        rng = self._random('group', groupid)
+        torrents = [self.torrent(torrentid, 'FLAC', 'Lossless') for torrentid in seeded]
+        # Some groups already have some of the transcodes
+        for n, (format, encoding) in enumerate(self.formats[2:]):
+            if rng.random() < 0.4:
+                torrents.append(self.torrent(-(groupid * 10 + n), format, encoding))
+        return success({'group': {'id': groupid, 'name': f'Album {groupid}', 'year': 2000, 'wikiBody': '',
+                                  'wikiImage': '', 'recordLabel': '', 'catalogueNumber': '', 'releaseType': 1,
+                                  'categoryId': 1, 'categoryName': 'Music', 'time': '2020-01-01 00:00:00',
+                                  'vanityHouse': False, 'isBookmarked': False, 'tags': ['rock'],
+                                  'musicInfo': {'artists': [{'id': 1, 'name': 'Artist'}], 'with': [],
+                                                'composers': [], 'dj': [], 'conductor': [], 'remixedBy': [],
+                                                'producer': []}},
+                        'torrents': torrents})
+
+    def torrent_info(self, params):
+        torrentid = int(params.get('id', 0))
+        if not self.first_torrent <= torrentid < self.first_torrent + self.seeding:
+            return failure('bad id parameter')
+        return success({'group': {'id': self.groupid(torrentid)},
+                        'torrent': self.torrent(torrentid, 'FLAC', 'Lossless')})
+
+    def requests_listing(self, params):
+        page = int(params.get('page', 1))
+        pages = -(-self.requests // self.request_page)
+        first = max(page - 1, 0) * self.request_page
+        results = []
+        for requestid in range(first + 1, min(first + self.request_page, self.requests) + 1):
+            rng = self._random('request', requestid)
+            results.append({'requestId': requestid, 'requestorId': 1, 'requestorName': 'standin',
+                            'timeAdded': '2020-01-01 00:00:00', 'voteCount': rng.randrange(1, 20),
+                            'bounty': rng.randrange(2 ** 27, 2 ** 34), 'categoryId': 1, 'categoryName': 'Music',
+                            'artists': [[{'id': str(requestid), 'name': f'Artist {requestid}'}]],
+                            'title': f'Title {requestid}', 'year': 2000, 'description': '', 'catalogueNumber': '',
+                            'releaseType': '', 'bitrateList': 'Lossless', 'formatList': 'FLAC', 'mediaList': 'CD',
+                            'logCue': '', 'isFilled': False, 'fillerId': 0, 'fillerName': '', 'torrentId': 0,
+                            'timeFilled': ''})
+        return success({'currentPage': page, 'pages': pages, 'results': results})
+
+    def notifications_listing(self, params):
+        page = int(params.get('page', 1))
+        first = max(page - 1, 0) * self.request_page
+        newest = self.first_torrent + self.seeding - 1
+        results = [{'torrentId': torrentid, 'groupId': self.groupid(torrentid), 'groupName': f'Album {torrentid}',
+                    'groupCategoryId': 1, 'format': 'FLAC', 'encoding': 'Lossless', 'media': 'CD', 'unread': True,
+                    'notificationTime': '2020-01-01 00:00:00'}
+                   for torrentid in range(newest - first, max(newest - first - self.request_page,
+                                                                newest - self.notifications), -1)]
+        return success({'currentPages': page, 'pages': -(-self.notifications // self.request_page),
+                        'numNew': self.notifications, 'results': results})
+
+    def better(self, params):
+        # Every third seeded torrent still misses a transcode
+        return success([{'torrentId': torrentid, 'groupId': self.groupid(torrentid),
+                         'downloadUrl': f'torrents.php?action=download&id={torrentid}'}
+                        for torrentid in self.torrentids() if torrentid % 3 == 0])
+
+    def download(self, params):
+        torrentid = int(params.get('id', 0))
+        name = f'Album {torrentid}'.encode()
+        info = (b'd6:lengthi%de4:name%d:%s12:piece lengthi262144e6:pieces20:%se'
+                % (self.files * 2 ** 25, len(name), name, bytes(20)))
+        return 200, 'application/x-bittorrent', b'd8:announce20:http://127.0.0.1/ann4:info' + info + b'e'
+
+    def upload(self, params):
+        with self._lock:
+            self.uploads += 1
+            torrentid = self.first_torrent + self.seeding + self.uploads
+        return success({'private': True, 'source': True, 'requestid': None, 'torrentid': torrentid,
+                        'groupid': int(params.get('groupid', 0) or 0)})
+
+    def respond(self, action, params):
+        handler = {'index': self.index,
+                   'user': self.user,
+                   'user_torrents': self.user_torrents,
+                   'torrentgroup': self.torrentgroup,
+                   'torrent': self.torrent_info,
+                   'requests': self.requests_listing,
+                   'notifications': self.notifications_listing,
+                   'better': self.better,
+                   'download': self.download,
+                   'upload': self.upload}.get(action)
+        if handler is None:
+            return failure('bad action')
+        return handler(params)
+
+
+class Recording:
+    '''
+    Responses captured from the real site, keyed by action and parameters.
+    Account secrets are blanked out of the index response, and out of every response stored
+    after it. Downloads are never stored: the announce url in a torrent holds the passkey.
+    '''
+    unrecorded = ('download', 'upload')
+    blank = b'0' * 32
+    # 32 hex digits on their own, the shape of the authkey and passkey
+    secret_pattern = re.compile(rb'(?<![0-9a-fA-F])[0-9a-fA-F]{32}(?![0-9a-fA-F])')
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._secrets = set()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS exchanges '
+                            '(key TEXT PRIMARY KEY, action TEXT, status INTEGER, content_type TEXT, body BLOB)')
+
+    @staticmethod
+    def key(action, params):
+        return json.dumps([action, params], sort_keys=True)
+
+    def get(self, action, params):
+        with self._lock:
+            row = self.db.execute('SELECT status, content_type, body FROM exchanges WHERE key = ?',
+                                  (self.key(action, params),)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, action, params, status, content_type, body):
+        if action in self.unrecorded:
+            return
+        if action == 'index' and content_type.startswith('application/json'):
+            try:
+                parsed = json.loads(body)
+                for secret in ('authkey', 'passkey'):
+                    if secret in parsed.get('response', {}):
+                        self._secrets.add(str(parsed['response'][secret]).encode())
+                        parsed['response'][secret] = self.blank.decode()
+                body = json.dumps(parsed).encode()
+            except ValueError:
+                pass
+        for secret in tuple(self._secrets):
+            if secret:
+                body = body.replace(secret, self.blank)
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO exchanges (key, action, status, content_type, body) '
+                            'VALUES (?, ?, ?, ?, ?)', (self.key(action, params), action, status, content_type, body))
+
+    def leaks(self):
+        '''Keys of the stored responses that hold 32 hex digits other than the blank'''
+        with self._lock:
+            rows = self.db.execute('SELECT key, body FROM exchanges').fetchall()
+        return [key for key, body in rows
+                if any(found != self.blank for found in self.secret_pattern.findall(bytes(body)))]
+
+    def close(self):
+        self.db.close()
+
+
+class Recorder:
+    '''
+    Forwards requests to the real site and stores what comes back (see Recording for what is not).
+    Uploads are refused, never forwarded.
+    '''
+    def __init__(self, recording, upstream='https://redacted.ch/'):
+        self.recording = recording
+        self.upstream = upstream
+        self._local = threading.local()
+
+    def respond(self, action, params, headers):
+        if action == 'upload':
+            return failure('uploads are not forwarded while recording')
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        r = session.get(f'{self.upstream}ajax.php', params=dict(params, action=action), allow_redirects=False,
+                        headers={'Authorization': headers.get('Authorization', ''), 'User-Agent': 'REDBetter3'})
+        content_type = r.headers.get('content-type', 'application/octet-stream')
+        if r.status_code == 200:
+            self.recording.put(action, params, r.status_code, content_type, r.content)
+        return r.status_code, content_type, r.content
+
+
+class Replayer:
+    '''
+    Serves a recording; what it doesn't hold comes from `fallback` (a SyntheticSite) or fails.
+    Downloads are not recorded, they are always synthetic torrents.
+    '''
+    def __init__(self, recording, fallback=None):
+        self.recording = recording
+        self.fallback = fallback
+        self.torrents = fallback if fallback is not None else SyntheticSite()
+
+    def respond(self, action, params, headers):
+        if action == 'download':
+            return self.torrents.download(params)
+        recorded = self.recording.get(action, params)
+        if recorded is not None:
+            return recorded
+        if self.fallback is not None:
+            return self.fallback.respond(action, params)
+        return failure('not in recording')
+
+
+class Synthetic:
+    def __init__(self, site):
+        self.site = site
+
+    def respond(self, action, params, headers):
+        return self.site.respond(action, params)
+
+
+class StandIn:
+    '''
+    The ajax.php endpoint: hands requests to `source` (Recorder, Replayer or Synthetic) after
+    `latency` (+ up to `jitter`) seconds. Past `rate_limit` requests in `rate_window` seconds it
+    answers like the site does, and `error_rate` of the requests fail with a 502.
+    '''
+    def __init__(self, source, latency=0.0, jitter=0.0, rate_limit=None, rate_window=10.0, error_rate=0.0,
+                 api_key=None):
+        self.source = source
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.api_key = api_key
+        self.counts = {}
+        self.rate_limited = 0
+        self._recent = []
+        self._lock = threading.Lock()
+        self.server = None
+
+    def _over_limit(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._recent = [sent for sent in self._recent if now - sent < self.rate_window]
+            if len(self._recent) >= self.rate_limit:
+                self.rate_limited += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    def handle(self, action, params, headers):
+        with self._lock:
+            self.counts[action] = self.counts.get(action, 0) + 1
+        if self.api_key is not None and headers.get('Authorization') != self.api_key:
+            # The site sends requests without a valid key to the login page
+            return 302, 'text/html', b''
+        if self._over_limit():
+            return failure('Rate limit exceeded')
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return 502, 'text/html', b'<html>Bad gateway</html>'
+        return self.source.respond(action, params, headers)
+
+    def start(self, host='127.0.0.1', port=0):
+        '''Serve from a background thread, returns the base url to give RedactedAPI'''
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes, Nagle would hold the body back for the client's ack
+            disable_nagle_algorithm = True
+
+            def _serve(self, params):
+                url = urllib.parse.urlparse(self.path)
+                if url.path != '/ajax.php':
+                    self._send(404, 'text/html', b'')
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True), **params)
+                action = params.pop('action', '')
+                self._send(*standin.handle(action, params, self.headers))
+
+            def _send(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if status == 302:
+                    self.send_header('Location', '/login.php')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._serve({})
+
+            def do_POST(self):
+                # Uploads are multipart; only the plain form fields are of interest here
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fields = {}
+                for part in body.split(b'\r\n--'):
+                    head, _, value = part.partition(b'\r\n\r\n')
+                    if b'filename=' in head or b'name="' not in head:
+                        continue
+                    name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                    fields[name] = value.rstrip(b'\r\n').decode(errors='replace')
+                self._serve(fields)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='ajax-standin', daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}/'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('mode', choices=['record', 'replay', 'synthetic', 'check'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--recording', default=Path('~/.redactedbetter/recording.sqlite').expanduser(),
+                        help='where responses are recorded to and replayed from')
+    parser.add_argument('--upstream', default='https://redacted.ch/', help='the site to record from')
+    parser.add_argument('--fill', action='store_true', default=False,
+                        help='in replay mode, answer requests missing from the recording with synthetic responses')
+    parser.add_argument('--seeding', type=int, default=2000, help='synthetic torrents seeding')
+    parser.add_argument('--group-size', type=int, default=3, help='synthetic seeded torrents per group')
+    parser.add_argument('--files', type=int, default=12, help='files per synthetic torrent')
+    parser.add_argument('--requests', type=int, default=5000, help='synthetic open requests')
+    parser.add_argument('--notifications', type=int, default=200, help='synthetic notifications')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more, at random')
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests allowed per --rate-window, like the site')
+    parser.add_argument('--rate-window', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 502')
+    parser.add_argument('--api-key', default=None, help='only accept this key')
+    parser.add_argument('-l', '--loglevel', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.loglevel.upper())
+    if args.mode == 'check':
+        if not Path(args.recording).is_file():
+            parser.error(f'no recording at {args.recording}')
+        recording = Recording(args.recording)
+        leaks = recording.leaks()
+        recording.close()
+        for key in leaks:
+            logger.error(f'Possible passkey in the response to {key}')
+        logger.info(f'{len(leaks)} responses hold 32 hex digits')
+        sys.exit(1 if leaks else 0)
+    site = SyntheticSite(args.seeding, args.group_size, args.files, args.requests, args.notifications)
+    recording = None
+    if args.mode == 'synthetic':
+        source = Synthetic(site)
+    else:
+        Path(args.recording).parent.mkdir(parents=True, exist_ok=True)
+        recording = Recording(args.recording)
+        if args.mode == 'record':
+            source = Recorder(recording, args.upstream)
+        else:
+            source = Replayer(recording, site if args.fill else None)
+
+    standin = StandIn(source, args.latency, args.jitter, args.rate_limit, args.rate_window, args.error_rate, args.api_key)
+    url = standin.start(args.host, args.port)
+    logger.info(f'Serving {args.mode} at {url}ajax.php, stop with ctrl-c')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.stop()
+        if recording is not None:
+            recording.close()
+        logger.info(f'Requests served: {standin.counts}, rate limited: {standin.rate_limited}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the cache, api and transcode building blocks
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import wave
+from pathlib import Path
+
+import mutagen.flac
+
+import transcode
+from cache import Cache, Reason, ReasonBitmap, Snapshot, atomic_write
+from ajaxstandin import StandIn, Synthetic, SyntheticSite
+from redactedapi import RateLimiter, RedactedAPI, apiTorrent, apiTorrentGroup, prefetch_torrentgroups, read_ahead, ut
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_cache_load(args):
+    """ Startup and lookup cost of the binary snapshot against the jsonpickle file it replaces """
+    reasons = ['done', 'no flac', 'scene', 'trumpable', '24bit', 'no_upload']
+    ids = sorted(random.sample(range(args.max_id), args.entries))
+    entries = [(torrent_id, random.choice(reasons)) for torrent_id in ids]
+    probes = [random.randrange(args.max_id) for _ in range(args.lookups)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshot_path = Path(tmpdir, 'cache')
+        atomic_write(snapshot_path, Snapshot.dump(entries))
+        cache, load_time = timed(Cache, snapshot_path)
+        hits, lookup_time = timed(lambda: sum(1 for probe in probes if probe in cache.ids))
+        cache.close()
+        print(f'binary snapshot : {snapshot_path.stat().st_size:>12} bytes, load {load_time * 1000:8.2f} ms, '
+              f'{args.lookups} lookups {lookup_time * 1000:8.2f} ms ({hits} hits)')
+
+        try:
+            import jsonpickle
+        except ImportError:
+            print('jsonpickle not installed, skipping the legacy format')
+            return
+        legacy_path = Path(tmpdir, 'legacy')
+        legacy_path.write_text(jsonpickle.encode({'ids': dict(entries)}))
+
+        def legacy_load():
+            cache = jsonpickle.decode(legacy_path.read_text())
+            return {int(key): cache['ids'][key] for key in cache['ids']}
+        legacy, load_time = timed(legacy_load)
+        hits, lookup_time = timed(lambda: sum(1 for probe in probes if probe in legacy))
+        print(f'jsonpickle dict : {legacy_path.stat().st_size:>12} bytes, load {load_time * 1000:8.2f} ms, '
+              f'{args.lookups} lookups {lookup_time * 1000:8.2f} ms ({hits} hits)')
+
+
+def measured(build):
+    """ Return what build() returns and the bytes it left allocated """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def resident_bytes():
+    """ Resident set size of this process, mapped snapshot pages included (Linux only) """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def bench_cache_memory(args):
+    """ Memory of a loaded Cache (mapped snapshot plus journalled entries) against a plain dict of the same entries """
+    reasons = [reason.value for reason in Reason]
+    entries = [(torrent_id, random.choice(reasons)) for torrent_id in random.sample(range(args.max_id), args.entries)]
+    snapshotted, journalled = sorted(entries[args.recent:]), entries[:args.recent]
+
+    # Fresh int and str objects per entry, the way decoding the old cache file produced them
+    plain, plain_bytes = measured(lambda: {int(str(torrent_id)): ''.join(list(reason)) for torrent_id, reason in entries})
+    print(f'{"dict":<12}: {plain_bytes / 2 ** 20:8.1f} MiB heap, {plain_bytes / args.entries:6.1f} bytes per entry')
+    del plain
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = Path(tmpdir, 'cache')
+        atomic_write(cache_path, Snapshot.dump(snapshotted))
+        # Leave the recent entries in the journal, the way a cache looks between compactions
+        cache = Cache(cache_path, compact_every=args.recent + 1)
+        for torrent_id, reason in journalled:
+            cache.add(torrent_id, reason)
+        cache.close()
+
+        before = resident_bytes()
+        cache, heap_bytes = measured(lambda: Cache(cache_path, compact_every=args.recent + 1))
+        # Touch every id so all snapshot pages are resident
+        assert sum(1 for torrent_id, _ in entries if torrent_id in cache.ids) == args.entries
+        after = resident_bytes()
+        resident = f', {(after - before) / 2 ** 20:8.1f} MiB resident' if before is not None else ''
+        print(f'{"Cache":<12}: {heap_bytes / 2 ** 20:8.1f} MiB heap{resident}, '
+              f'{cache_path.stat().st_size / 2 ** 20:.1f} MiB snapshot mapped, {args.recent} entries in the journal')
+        cache.close()
+
+    # The bitmap only holds the journalled entries in a Cache, this is its cost if it held all of them
+    bitmap, bitmap_bytes = measured(lambda: ReasonBitmap(entries))
+    assert len(bitmap) == args.entries
+    print(f'{"ReasonBitmap":<12}: {bitmap_bytes / 2 ** 20:8.1f} MiB heap holding all {args.entries} entries (bitmap only)')
+
+
+class EagerTorrent():
+    """ apiTorrent as it was before slots: a __dict__ per instance and the file list split up front """
+    def __init__(self, **entries):
+        self.__dict__.update(entries)
+        if self.fileList:
+            self.fileList = ut.split_filelist(self.fileList)
+
+
+def torrentgroup_response(torrents, files):
+    """ A torrentgroup response shaped like the api's, with torrents * files entries in the file lists """
+    group = {'id': 1, 'name': 'Box Set', 'year': 2000, 'wikiBody': 'x' * 2000, 'tags': ['rock'],
+             'musicInfo': {'artists': [{'id': 1, 'name': 'Artist'}]}}
+    response = []
+    for torrent_id in range(torrents):
+        file_list = '|||'.join(f'CD{n // 20 + 1:02}/{n % 20 + 1:02} - Track &amp; Title.flac{{{{{{{random.randrange(2 ** 20, 2 ** 26)}}}}}}}'
+                               for n in range(files))
+        response.append({'id': torrent_id, 'format': 'FLAC', 'encoding': 'Lossless', 'media': 'CD',
+                         'remasterYear': 2000, 'remasterTitle': '', 'remasterRecordLabel': '',
+                         'remasterCatalogueNumber': '', 'scene': False, 'hasLog': True, 'hasCue': True,
+                         'logScore': 100, 'fileCount': files, 'size': 2 ** 30, 'seeders': 10, 'leechers': 0,
+                         'snatched': 20, 'freeTorrent': False, 'reported': False, 'time': '2020-01-01 00:00:00',
+                         'description': '', 'fileList': file_list, 'filePath': 'Box Set', 'userId': 1,
+                         'username': 'user', 'trumpable': False, 'infoHash': 'ab' * 20})
+    return group, response
+
+
+def bench_models(args):
+    """ Build and first-use cost of the slotted, lazily split torrent models against the eager dict-based ones """
+    group, torrents = torrentgroup_response(args.torrents, args.files)
+    wanted = args.torrents // 2
+
+    def build(torrent_class):
+        tgroup = apiTorrentGroup(**dict(group))
+        for _ in range(args.groups):
+            tgroup.torrents.extend(torrent_class(**dict(torrent)) for torrent in torrents)
+        return tgroup
+
+    def use(tgroup):
+        # What the main loop does: find the torrent being checked and read its first file
+        return next(t for t in tgroup.torrents if t.id == wanted).fileList[0][0]
+
+    for label, torrent_class in (('eager dict', EagerTorrent), ('slotted lazy', apiTorrent)):
+        (tgroup, build_time), size = measured(lambda: timed(build, torrent_class))
+        _, use_time = timed(use, tgroup)
+        print(f'{label:<12}: build {build_time * 1000:8.2f} ms, first use {use_time * 1000:6.2f} ms, '
+              f'{size / 2 ** 20:8.2f} MiB for {len(tgroup.torrents)} torrents of {args.files} files')
+
+
+def bench_pipeline(args):
+    """ Candidate evaluation throughput against a local ajax.php stand-in with site-like latency and rate limit """
+    from redactedbetter import formats_needed, group_candidates
+
+    standin = StandIn(Synthetic(SyntheticSite(args.seeding, args.group_size)), latency=args.latency,
+                      jitter=args.latency / 2, rate_limit=args.rate_limit, rate_window=args.rate_window)
+    site = standin.start()
+    try:
+        for prefetch in args.prefetch:
+            api = RedactedAPI(args.page_size, 'standin', mainpage=site,
+                              limiter=RateLimiter(args.rate_limit, args.rate_window))
+            start = time.perf_counter()
+            candidates = read_ahead(group_candidates(api.get_seeding(), args.page_size), 2 * args.page_size)
+            if prefetch > 0:
+                candidates = prefetch_torrentgroups(api, candidates, lambda groupid, torrentid: True, prefetch)
+            needed = 0
+            for groupid, torrentid in candidates:
+                group = api.get_api_torrentgroup(groupid)
+                torrent = next(t for t in group.torrents if t.id == torrentid)
+                needed += len(formats_needed(group, torrent, ['V0', '320']))
+                # The checks of the files on disk the real main loop does before it moves on
+                time.sleep(args.work)
+            elapsed = time.perf_counter() - start
+            print(f'prefetch {prefetch:>3}: {args.seeding} candidates in {elapsed:7.2f} s '
+                  f'({args.seeding / elapsed:7.1f}/s), {needed} transcodes needed, '
+                  f'waited {api.limiter.waited:6.1f} s for the rate limit')
+    finally:
+        standin.stop()
+    print(f'stand-in served {standin.counts}, rate limited {standin.rate_limited}')
+
+
+def write_flac(path, sample_rate=44100, bits=16, channels=2, seconds=240, picture=0, audio=4096):
+    """ A FLAC file with a real STREAMINFO, tags, optionally a picture of `picture` bytes and `audio` bytes of noise for frames """
+    samples = sample_rate * seconds
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples
+    blocks = [(0, struct.pack('>HH', 4096, 4096) + bytes(6) + packed.to_bytes(8, 'big') + os.urandom(16))]
+    if picture:
+        mime = b'image/jpeg'
+        blocks.append((6, struct.pack('>II', 3, len(mime)) + mime + struct.pack('>IIIIII', 0, 1000, 1000, 24, 0, picture)
+                       + os.urandom(picture)))
+    comments = [b'ARTIST=Artist', b'ALBUM=Box Set', b'TITLE=Track']
+    blocks.append((4, struct.pack('<I', 6) + b'bench!' + struct.pack('<I', len(comments))
+                   + b''.join(struct.pack('<I', len(comment)) + comment for comment in comments)))
+    with open(path, 'wb') as f:
+        f.write(b'fLaC')
+        for n, (kind, data) in enumerate(blocks):
+            f.write(bytes([(0x80 if n == len(blocks) - 1 else 0) | kind]) + len(data).to_bytes(3, 'big') + data)
+        f.write(b'\xff\xf8' + os.urandom(audio))
+
+
+def box_set(root, discs, tracks, **flac):
+    """ A release of `discs` CD folders of `tracks` FLACs each """
+    for disc in range(1, discs + 1):
+        disc_dir = Path(root, f'CD{disc:02}')
+        disc_dir.mkdir(parents=True)
+        for track in range(1, tracks + 1):
+            write_flac(disc_dir / f'{track:02} - Track.flac', **flac)
+    return root
+
+
+def bench_probe(args):
+    """ Reading a many-disc box set once into a ReleaseProbe against every check walking and parsing it again """
+    formats = ['V0', '320', 'FLAC']
+
+    def checks(release):
+        # What the main loop asks about a release before and while transcoding it
+        transcode.is_24bit(release)
+        transcode.is_multichannel(release)
+        transcode.needs_resampling(release)
+        for format in formats:
+            transcode.transcode_commands(format, transcode.needs_resampling(release), transcode.resample_rate(release),
+                                         'input.flac', 'output')
+
+    def per_directory(flac_dir):
+        checks(flac_dir)
+        # and the transcode read every file again
+        for flac_file in transcode.locate(flac_dir, transcode.ext_matcher('.flac')):
+            transcode.read_flac_info(flac_file)
+
+    def probed(flac_dir):
+        probe = transcode.ReleaseProbe.scan(flac_dir)
+        checks(probe)
+        return probe
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flac_dir = box_set(tmpdir, args.discs, args.tracks, bits=24, sample_rate=96000, picture=args.picture)
+        for label, run in (('per directory', per_directory), ('ReleaseProbe', probed)):
+            best = min(timed(run, flac_dir)[1] for _ in range(args.repeat))
+            print(f'{label:<14}: {best * 1000:8.2f} ms for {args.discs * args.tracks} files, best of {args.repeat}')
+
+
+def bench_streaminfo(args):
+    """ The native STREAMINFO reader against mutagen on FLACs with large embedded artwork """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = [Path(tmpdir, f'{n:03}.flac') for n in range(args.files)]
+        for path in files:
+            write_flac(path, sample_rate=random.choice([44100, 48000, 96000]), bits=random.choice([16, 24]),
+                       seconds=random.randrange(60, 600), picture=args.picture)
+        for path in files:
+            info = mutagen.flac.FLAC(path).info
+            assert transcode.read_streaminfo(path)[1:5] == (info.sample_rate, info.bits_per_sample, info.channels, info.length)
+
+        def read(reader):
+            for path in files:
+                reader(path)
+        for label, reader in (('mutagen', mutagen.flac.FLAC), ('read_streaminfo', transcode.read_streaminfo)):
+            best = min(timed(read, reader)[1] for _ in range(args.repeat))
+            print(f'{label:<16}: {best * 1000:8.2f} ms for {args.files} files with {args.picture / 2 ** 20:.1f} MiB of artwork, '
+                  f'{best / args.files * 1e6:8.1f} us per file, best of {args.repeat}')
+
+
+def simulated_transcode(seconds):
+    time.sleep(seconds)
+
+
+def flac_release(root, minutes, seconds_per_minute):
+    """ Tagged FLACs of noise, `seconds_per_minute` seconds of audio for every minute in `minutes`, made with flac """
+    for n, length in enumerate(minutes, 1):
+        wav, flac = Path(root, f'{n:02}.wav'), Path(root, f'{n:02}.flac')
+        with wave.open(str(wav), 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(os.urandom(int(length * seconds_per_minute * 44100) * 4))
+        subprocess.run(['flac', '--silent', '-f', '-o', str(flac), '-T', 'ARTIST=Artist', '-T', 'ALBUM=Album',
+                        '-T', f'TITLE=Track {n}', '-T', f'TRACKNUMBER={n}/{len(minutes)}', str(wav)], check=True)
+        wav.unlink()
+    return transcode.ReleaseProbe.scan(root)
+
+
+def bench_schedule(args):
+    """ Wall clock of a release transcoded in walk order against longest job first, with skewed track lengths """
+    # Minutes of audio per track, in the order os.walk would find them
+    releases = {
+        'long closing track': [4] * (args.tracks - 1) + [20],
+        'two long tracks': [3] * (args.tracks - 2) + [15, 12],
+        'lognormal lengths': [min(random.lognormvariate(1.3, 0.6), 30) for _ in range(args.tracks)],
+    }
+    if args.real and not (shutil.which('flac') and shutil.which('lame')):
+        print('--real needs flac and lame on the PATH')
+        return
+
+    with multiprocessing.Pool(args.workers) as pool, tempfile.TemporaryDirectory() as tmpdir:
+        for label, minutes in releases.items():
+            if args.real:
+                # The real thing: decode once and encode to V0 and 320 the way the scheduler's workers do
+                flac_dir = Path(tmpdir, label)
+                flac_dir.mkdir()
+                jobs = list(flac_release(flac_dir, minutes, args.seconds_per_minute))
+
+                def start(info, run):
+                    outputs = {format: str(Path(tmpdir, run, label, format)) for format in ('V0', '320')}
+                    return pool.apply_async(transcode.pool_transcode_formats, ((info, outputs),))
+            else:
+                # Synthetic: a worker sleeps for exactly the length the jobs are ordered by
+                jobs = [transcode.FlacInfo(f'{n:02}.flac', 44100, 16, 2, length * 60, 0, 0) for n, length in enumerate(minutes)]
+
+                def start(info, run):
+                    return pool.apply_async(simulated_transcode, (info.length * args.scale,))
+
+            def run(order, name):
+                begin = time.perf_counter()
+                for result in [start(info, name) for info in order]:
+                    result.get()
+                return time.perf_counter() - begin
+            walk_time = run(jobs, 'walk')
+            sorted_time = run(sorted(jobs, key=transcode.job_length, reverse=True), 'sorted')
+            print(f'{label:<18}: walk order {walk_time:6.2f} s, longest first {sorted_time:6.2f} s on {args.workers} workers'
+                  f' ({"real encodes" if args.real else "synthetic sleeps"})')
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    cache_load = subparsers.add_parser('cache-load', help=bench_cache_load.__doc__)
+    cache_load.add_argument('-n', '--entries', type=int, default=500000, help='number of cached ids')
+    cache_load.add_argument('--max-id', type=int, default=6000000, help='ids are drawn from 0..max-id')
+    cache_load.add_argument('--lookups', type=int, default=100000, help='number of membership tests')
+    cache_load.set_defaults(function=bench_cache_load)
+
+    cache_memory = subparsers.add_parser('cache-memory', help=bench_cache_memory.__doc__)
+    cache_memory.add_argument('-n', '--entries', type=int, default=1000000, help='number of cached ids')
+    cache_memory.add_argument('--max-id', type=int, default=6000000, help='ids are drawn from 0..max-id')
+    cache_memory.add_argument('--recent', type=int, default=4000, help='entries still in the journal, below compact_every')
+    cache_memory.set_defaults(function=bench_cache_memory)
+
+    models = subparsers.add_parser('models', help=bench_models.__doc__)
+    models.add_argument('--torrents', type=int, default=120, help='torrents per group')
+    models.add_argument('--files', type=int, default=40, help='files per torrent, a few thousand for box sets')
+    models.add_argument('--groups', type=int, default=10, help='copies of the group kept alive at once')
+    models.set_defaults(function=bench_models)
+
+    pipeline = subparsers.add_parser('pipeline', help=bench_pipeline.__doc__)
+    pipeline.add_argument('--seeding', type=int, default=300, help='torrents seeding on the stand-in')
+    pipeline.add_argument('--group-size', type=int, default=3, help='seeded torrents per group')
+    pipeline.add_argument('-p', '--page-size', type=int, default=100)
+    pipeline.add_argument('--latency', type=float, default=0.05, help='seconds per response')
+    pipeline.add_argument('--rate-limit', type=int, default=50, help='requests per --rate-window on both ends')
+    pipeline.add_argument('--rate-window', type=float, default=1.0)
+    pipeline.add_argument('--prefetch', type=int, nargs='+', default=[0, 16], help='prefetch depths to compare')
+    pipeline.add_argument('--work', type=float, default=0.02, help='seconds the main loop spends on each candidate')
+    pipeline.set_defaults(function=bench_pipeline)
+
+    probe = subparsers.add_parser('probe', help=bench_probe.__doc__)
+    probe.add_argument('--discs', type=int, default=20)
+    probe.add_argument('--tracks', type=int, default=15, help='tracks per disc')
+    probe.add_argument('--picture', type=int, default=0, help='bytes of artwork embedded in every file')
+    probe.add_argument('--repeat', type=int, default=5)
+    probe.set_defaults(function=bench_probe)
+
+    streaminfo = subparsers.add_parser('streaminfo', help=bench_streaminfo.__doc__)
+    streaminfo.add_argument('--files', type=int, default=100)
+    streaminfo.add_argument('--picture', type=int, default=4 * 2 ** 20, help='bytes of artwork embedded in every file')
+    streaminfo.add_argument('--repeat', type=int, default=5)
+    streaminfo.set_defaults(function=bench_streaminfo)
+
+    schedule = subparsers.add_parser('schedule', help=bench_schedule.__doc__)
+    schedule.add_argument('--workers', type=int, default=4)
+    schedule.add_argument('--tracks', type=int, default=12)
+    schedule.add_argument('--scale', type=float, default=0.005, help='seconds a worker sleeps per second of audio')
+    schedule.add_argument('--real', action='store_true', default=False,
+                          help='transcode real FLACs with flac and lame instead of sleeping')
+    schedule.add_argument('--seconds-per-minute', type=float, default=3,
+                          help='with --real, seconds of audio made for every minute of track length')
+    schedule.set_defaults(function=bench_schedule)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,1096 @@
 #!/usr/bin/env python3
 
+from array import array
+import atexit
+import bisect
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager
+from enum import Enum
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
 from pathlib import Path
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
 import jsonpickle
 
+logger = logging.getLogger(__name__)
+
+
+class Reason(str, Enum):
+    """ Known cache reasons; members compare and hash equal to their plain strings """
+    DONE = 'done'
+    NO_FLAC = 'no flac'
+    SCENE = 'scene'
+    TRUMPABLE = 'trumpable'
+    BIT24 = '24bit'
+    NO_UPLOAD = 'no_upload'
+    ERROR = 'error'
+    MATCH = 'match'
+    NO_MATCH = 'no match'
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self, format_spec):
+        return self.value.__format__(format_spec)
+
+
+# Map a reason string to its shared Reason member (or an interned string for
+# reasons this version does not know), so equal reasons are one object
+def intern_reason(reason):
+    try:
+        return Reason(reason)
+    except ValueError:
+        return sys.intern(str(reason))
+
+
+class ReasonBitmap(MutableMapping):
+    """ dict-like id -> reason map stored as one bitset per reason
+
+    Each bitset is split into chunks of 2**chunk_bits ids that are only
+    allocated once an id in their range is set, so sparse id ranges stay
+    cheap. An id is in at most one bitset; setting it moves it.
+    """
+    chunk_bits = 13
+
+    def __init__(self, items=()):
+        self._bitsets = {}
+        self._len = 0
+        self.update(items)
+
+    def _locate(self, key):
+        key = int(key)
+        if key < 0:
+            raise KeyError(key)
+        offset = key & ((1 << self.chunk_bits) - 1)
+        return key >> self.chunk_bits, offset >> 3, 1 << (offset & 7)
+
+    def _find(self, chunk, byte, mask):
+        for reason, chunks in self._bitsets.items():
+            bits = chunks.get(chunk)
+            if bits is not None and bits[byte] & mask:
+                return reason
+        return None
+
+    def __getitem__(self, key):
+        try:
+            reason = self._find(*self._locate(key))
+        except (TypeError, ValueError):
+            reason = None
+        if reason is None:
+            raise KeyError(key)
+        return reason
+
+    def __contains__(self, key):
+        try:
+            return self._find(*self._locate(key)) is not None
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __setitem__(self, key, reason):
+        reason = intern_reason(reason)
+        chunk, byte, mask = self._locate(key)
+        old = self._find(chunk, byte, mask)
+        if old is reason:
+            return
+        if old is None:
+            self._len += 1
+        else:
+            self._clear(old, chunk, byte, mask)
+        chunks = self._bitsets.setdefault(reason, {})
+        bits = chunks.get(chunk)
+        if bits is None:
+            bits = chunks[chunk] = bytearray(1 << (self.chunk_bits - 3))
+        bits[byte] |= mask
+
+    def __delitem__(self, key):
+        chunk, byte, mask = self._locate(key)
+        old = self._find(chunk, byte, mask)
+        if old is None:
+            raise KeyError(key)
+        self._clear(old, chunk, byte, mask)
+        self._len -= 1
+
+    def _clear(self, reason, chunk, byte, mask):
+        chunks = self._bitsets[reason]
+        bits = chunks[chunk]
+        bits[byte] &= ~mask
+        if not any(bits):
+            del chunks[chunk]
+            if not chunks:
+                del self._bitsets[reason]
+
+    def _keys(self, chunks):
+        for chunk, bits in chunks.items():
+            base = chunk << self.chunk_bits
+            for byte_index, byte in enumerate(bits):
+                if byte:
+                    for bit in range(8):
+                        if byte >> bit & 1:
+                            yield base + (byte_index << 3) + bit
+
+    # (id, reason) pairs in id order
+    def items(self):
+        return sorted((key, reason) for reason, chunks in self._bitsets.items() for key in self._keys(chunks))
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def __len__(self):
+        return self._len
+
+    def with_reason(self, *reasons):
+        found = set()
+        for reason in reasons:
+            found.update(self._keys(self._bitsets.get(reason, {})))
+        return found
+
+
+# Write data to a temporary file next to path and rename it over path, so
+# readers (and a crash) see either the old or the new file, never a partial one
+def atomic_write(path, data: bytes):
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """ Read-only, memory-mapped binary cache snapshot
+
+    Layout (little endian): magic, reason count, id count, the reason table as
+    length-prefixed utf-8 strings padded to 8 bytes, the sorted int64 ids and
+    one uint8 reason code per id. Lookups bisect the mapped id array, so
+    nothing is decoded into Python objects until it is asked for.
+    """
+    magic = b'RBCSNAP1'
+    header = struct.Struct('<8sII')
+
+    def __init__(self, ids=None, codes=None, reasons=()):
+        self._mmap = None
+        self.ids = ids if ids is not None else array('q')
+        self.codes = codes if codes is not None else b''
+        self.reasons = [intern_reason(reason) for reason in reasons]
+
+    @classmethod
+    def is_snapshot(cls, path):
+        with open(path, 'rb') as snapshot_file:
+            return snapshot_file.read(len(cls.magic)) == cls.magic
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as snapshot_file:
+            mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, reason_count, count = cls.header.unpack_from(mapped, 0)
+        if magic != cls.magic:
+            mapped.close()
+            raise ValueError(f'{path} is not a cache snapshot')
+        offset = cls.header.size
+        reasons = []
+        for _ in range(reason_count):
+            (length,) = struct.unpack_from('<H', mapped, offset)
+            offset += 2
+            reasons.append(intern_reason(mapped[offset:offset + length].decode()))
+            offset += length
+        offset += -offset % 8
+        view = memoryview(mapped)
+        codes = view[offset + 8 * count:offset + 9 * count]
+        if sys.byteorder == 'little':
+            ids = view[offset:offset + 8 * count].cast('q')
+        else:
+            # Snapshots are little endian, big endian hosts pay for a copy
+            ids = array('q', bytes(view[offset:offset + 8 * count]))
+            ids.byteswap()
+        snapshot = cls(ids, codes, reasons)
+        snapshot._mmap = mapped
+        return snapshot
+
+    # Serialise sorted (id, reason) pairs
+    @classmethod
+    def dump(cls, items):
+        reasons = {}
+        ids = array('q')
+        codes = bytearray()
+        for key, reason in items:
+            ids.append(key)
+            codes.append(reasons.setdefault(reason, len(reasons)))
+        if len(reasons) > 256:
+            raise ValueError('a cache snapshot holds at most 256 distinct reasons')
+        parts = [cls.header.pack(cls.magic, len(reasons), len(ids))]
+        for reason in reasons:
+            encoded = reason.encode()
+            parts.append(struct.pack('<H', len(encoded)) + encoded)
+        size = sum(len(part) for part in parts)
+        parts.append(b'\0' * (-size % 8))
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        parts.append(ids.tobytes())
+        parts.append(bytes(codes))
+        return b''.join(parts)
+
+    def _index(self, key):
+        index = bisect.bisect_left(self.ids, key)
+        if index < len(self.ids) and self.ids[index] == key:
+            return index
+        return -1
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        if index < 0:
+            return default
+        return self.reasons[self.codes[index]]
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    # (id, reason) pairs in id order
+    def items(self):
+        for key, code in zip(self.ids, self.codes):
+            yield key, self.reasons[code]
+
+    def with_reason(self, *reasons):
+        wanted = {self.reasons.index(reason) for reason in reasons if reason in self.reasons}
+        found = set()
+        codes = bytes(self.codes)
+        for code in wanted:
+            index = codes.find(code)
+            while index >= 0:
+                found.add(self.ids[index])
+                index = codes.find(code, index + 1)
+        return found
+
+    def close(self):
+        if self._mmap is not None:
+            # The views must be released before the map can be closed
+            for view in (self.ids, self.codes):
+                if isinstance(view, memoryview):
+                    view.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+class SeedingSnapshot:
+    """ The seeding list as (groupid, torrentid) pairs, in the order the api returned them
+
+    Layout (little endian): magic, pair count, then the pairs as int64s.
+    Small enough (16 bytes a torrent) to be read in full.
+    """
+    magic = b'RBCSEED1'
+    header = struct.Struct('<8sQ')
+
+    @classmethod
+    def load(cls, path):
+        data = Path(path).read_bytes()
+        magic, count = cls.header.unpack_from(data, 0)
+        if magic != cls.magic:
+            raise ValueError(f'{path} is not a seeding snapshot')
+        values = array('q', data[cls.header.size:cls.header.size + 16 * count])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return list(zip(values[0::2], values[1::2]))
+
+    @classmethod
+    def dump(cls, pairs):
+        values = array('q')
+        for groupid, torrentid in pairs:
+            values.append(groupid)
+            values.append(torrentid)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return cls.header.pack(cls.magic, len(values) // 2) + values.tobytes()
+
+
+class NotificationMark:
+    """ How far the notifications feed has been read
+
+    mark is the highest torrent id handled. pending maps torrent ids that were
+    announced but not seeding yet (still downloading) to [groupid, first seen].
+    """
+    def __init__(self, mark=0, pending=None):
+        self.mark = mark
+        self.pending = pending if pending is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        if not Path(path).exists():
+            return cls()
+        state = json.loads(Path(path).read_text())
+        return cls(state['mark'], {int(torrentid): entry for torrentid, entry in state['pending'].items()})
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, json.dumps({'mark': self.mark, 'pending': self.pending}).encode())
+
+
+class CacheIds(Mapping):
+    """ Dict view of a Cache: recent (journal) entries over the snapshot """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getitem__(self, key):
+        if key in self.cache._recent:
+            return self.cache._recent[key]
+        reason = self.cache._snapshot.get(key)
+        if reason is None:
+            raise KeyError(key)
+        return reason
+
+    def __contains__(self, key):
+        return key in self.cache._recent or key in self.cache._snapshot
+
+    def __iter__(self):
+        for key, _ in self.cache._merged_items():
+            yield key
+
+    def __len__(self):
+        return len(self.cache._snapshot) + sum(1 for key in self.cache._recent if key not in self.cache._snapshot)
+
 
 class Cache:
     """ Read cache from file and if not existing, create one
     This needs to be expanded since there are multiple reasons per id possible:
     formats or done
+
+    The cache file itself is a binary Snapshot that is memory-mapped rather
+    than decoded. Every add is appended as one record to a journal next to it
+    (`<cache>.journal`), which is fsynced every `fsync_every` records and
+    folded back into the snapshot once it holds `compact_every` records.
+    Loading maps the snapshot and replays the journal on top of it into a
+    ReasonBitmap; `ids` presents both as one read-only dict whose values are
+    shared Reason members rather than one string per entry.
+
+    Several processes, also on different hosts sharing the files over NFS, can
+    use the same cache. Writers hold an exclusive lockf() lock on
+    `<cache>.lock` and first merge what others appended to the journal (or a
+    snapshot another process compacted) before appending their own records.
+    claim() lets workers split a candidate list without doing the same id
+    twice; claims expire after `claim_ttl` seconds in case a worker dies.
+
+    Group fingerprints (see set_fingerprint) are journalled the same way and
+    compacted into `<cache>.groups`. They are keyed by torrent id: the
+    fingerprint of the torrent's group when the torrent was last evaluated.
     """
 
-    def __init__(self, cache_path):
-        self.ids = {}
+    def __init__(self, cache_path, fsync_every=64, compact_every=4096, claim_ttl=6 * 60 * 60):
         self.cache_path = Path(cache_path)
+        self.journal_path = self.cache_path.with_name(self.cache_path.name + '.journal')
+        self.lock_path = self.cache_path.with_name(self.cache_path.name + '.lock')
+        self.groups_path = self.cache_path.with_name(self.cache_path.name + '.groups')
+        self.fsync_every = fsync_every
+        self.compact_every = compact_every
+        self.claim_ttl = claim_ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.ids = CacheIds(self)
+        self._snapshot = Snapshot()
+        self._snapshot_stat = None
+        self._recent = ReasonBitmap()
+        self._claims = {}
+        self._groups = {}
+        self._journal = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._unsynced = 0
+        self._lock_file = None
         self.load()
 
+    @contextmanager
+    def _locked(self, exclusive=True):
+        fcntl.lockf(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_UN)
+
     # Load cache from file and if not existing, create one
     def load(self):
-        if self.cache_path.is_file():
-            with open(self.cache_path, 'r') as cache_file:
-                cache = jsonpickle.decode(cache_file.read())
-                self.ids = {int(key): cache.ids[key] for key in cache.ids}
+        self.close()
+        self._lock_file = open(self.lock_path, 'a+b')
+        with self._locked():
+            if self.cache_path.is_file() and not Snapshot.is_snapshot(self.cache_path):
+                # Older versions stored a jsonpickled dict (or the whole Cache
+                # object); convert it to a binary snapshot once
+                with open(self.cache_path, 'r') as cache_file:
+                    cache = jsonpickle.decode(cache_file.read())
+                    ids = cache['ids'] if isinstance(cache, dict) else cache.ids
+                    self._recent = ReasonBitmap((int(key), ids[key]) for key in ids)
+                self._snapshot = Snapshot()
+                self._journal_offset = 0
+                self._read_journal(repair=True)
+                self._write_snapshot()
+                if self.journal_path.is_file():
+                    os.truncate(self.journal_path, 0)
+            elif not self.cache_path.is_file():
+                self._write_snapshot()
+            self._reload(repair=True)
+        self._journal = open(self.journal_path, 'ab')
+
+    # Map the current snapshot and replay the whole journal on top of it
+    def _reload(self, repair=False):
+        self._snapshot.close()
+        self._snapshot = Snapshot.open(self.cache_path)
+        self._snapshot_stat = self._stat(self.cache_path)
+        self._recent = ReasonBitmap()
+        self._claims = {}
+        self._groups = {}
+        if self.groups_path.is_file():
+            with open(self.groups_path, 'r') as groups_file:
+                self._groups = {int(key): tuple(value) for key, value in json.load(groups_file).items()}
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._read_journal(repair)
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    # Pick up what other processes appended or compacted since we last looked
+    def _refresh(self, repair=False):
+        try:
+            journal_size = self.journal_path.stat().st_size
+        except FileNotFoundError:
+            journal_size = 0
+        if self._stat(self.cache_path) != self._snapshot_stat or journal_size < self._journal_offset:
+            self._reload(repair)
+        elif journal_size > self._journal_offset:
+            self._read_journal(repair)
+
+    # Apply complete journal records past the current offset. A torn record
+    # can only be left by a writer that crashed, so with the exclusive lock
+    # held (repair) it is cut off before anything is appended after it.
+    def _read_journal(self, repair=False):
+        if not self.journal_path.is_file():
+            return
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self._journal_offset)
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record)
+                self._journal_offset += len(line)
+                self._journal_records += 1
+        if repair and self._journal_offset != self.journal_path.stat().st_size:
+            os.truncate(self.journal_path, self._journal_offset)
+
+    def _apply(self, record):
+        if 'group' in record:
+            self._groups[int(record['group'])] = (record['fingerprint'], record['time'])
+            return
+        torrent_id = int(record['id'])
+        if 'claim' in record:
+            self._claims[torrent_id] = (record['claim'], record['time'])
+        elif 'release' in record:
+            if self._claims.get(torrent_id, (None,))[0] == record['release']:
+                del self._claims[torrent_id]
         else:
-            with open(self.cache_path, 'w') as cache_file:
-                encoded = jsonpickle.encode(self)
-                cache_file.write(encoded)
-
-    # Add item to cache and store cache in file
-    def add(self, torrent_id: str, reason: str):
-        self.ids[torrent_id] = reason
-        with open(str(self.cache_path), 'w') as cache_file:
-            encoded = jsonpickle.encode(self)
-            cache_file.write(encoded)
+            self._recent[torrent_id] = record['reason']
+            self._claims.pop(torrent_id, None)
+
+    # Snapshot and recent entries merged in id order, recent entries win
+    def _merged_items(self):
+        recent = self._recent.items()
+        position = 0
+        for key, reason in self._snapshot.items():
+            while position < len(recent) and recent[position][0] < key:
+                yield recent[position]
+                position += 1
+            if position < len(recent) and recent[position][0] == key:
+                yield recent[position]
+                position += 1
+            else:
+                yield key, reason
+        yield from recent[position:]
+
+    # Write snapshot plus recent entries as the new snapshot and map it
+    def _write_snapshot(self):
+        atomic_write(self.cache_path, Snapshot.dump(self._merged_items()))
+        self._snapshot.close()
+        self._snapshot = Snapshot.open(self.cache_path)
+        self._snapshot_stat = self._stat(self.cache_path)
+        self._recent = ReasonBitmap()
+
+    @staticmethod
+    def _journal_record(torrent_id, reason, format):
+        record = {'id': int(torrent_id), 'reason': reason}
+        if format is not None:
+            record['format'] = format
+        return record
+
+    # Merge others' records, then append ours; callers hold the exclusive lock
+    def _append(self, records):
+        self._refresh(repair=True)
+        data = b''.join(json.dumps(record).encode() + b'\n' for record in records)
+        self._journal.write(data)
+        self._journal.flush()
+        for record in records:
+            self._apply(record)
+        self._journal_offset += len(data)
+        self._journal_records += len(records)
+        self._unsynced += len(records)
+        if self._journal_records >= self.compact_every:
+            self._compact()
+
+    # Add item to cache and append it to the journal
+    def add(self, torrent_id: str, reason: str, format: str = None):
+        with self._locked():
+            self._append([self._journal_record(torrent_id, reason, format)])
+            if self._unsynced >= self.fsync_every:
+                self.sync()
+
+    # Group commit: append all (id, reason, format) entries with one write and one fsync
+    def add_many(self, entries):
+        records = [self._journal_record(torrent_id, reason, format) for torrent_id, reason, format in entries]
+        if not records:
+            return
+        with self._locked():
+            self._append(records)
+            self.sync()
+
+    def claim(self, torrent_id, retry=False):
+        """ Reserve torrent_id for this process
+
+        Returns False if another process holds a live claim on it or, unless
+        retry is set, if it already has a decision. The claim ends with the
+        next add() for the id or with release().
+        """
+        torrent_id = int(torrent_id)
+        with self._locked():
+            self._refresh(repair=True)
+            if not retry and torrent_id in self.ids:
+                return False
+            owner, claimed = self._claims.get(torrent_id, (None, 0))
+            if owner == self.owner:
+                return True
+            if owner is not None and time.time() - claimed < self.claim_ttl:
+                return False
+            self._append([{'id': torrent_id, 'claim': self.owner, 'time': time.time()}])
+            self.sync()
+        return True
+
+    # Give up a claim without recording a decision, so another worker may take it
+    def release(self, torrent_id):
+        self.release_many([torrent_id])
+
+    # Give up several claims with one write
+    def release_many(self, torrent_ids):
+        with self._locked():
+            self._refresh(repair=True)
+            records = [{'id': torrent_id, 'release': self.owner} for torrent_id in map(int, torrent_ids)
+                       if self._claims.get(torrent_id, (None,))[0] == self.owner]
+            if records:
+                self._append(records)
+
+    # (group fingerprint, time recorded) stored for a torrent id, or None
+    def fingerprint(self, torrent_id):
+        return self._groups.get(int(torrent_id))
+
+    def set_fingerprint(self, torrent_id, fingerprint: str):
+        self.set_fingerprints([(torrent_id, fingerprint, time.time())])
+
+    # Record several (torrent id, fingerprint, time) entries with one write
+    def set_fingerprints(self, entries):
+        records = [{'group': int(torrent_id), 'fingerprint': fingerprint, 'time': recorded}
+                   for torrent_id, fingerprint, recorded in entries]
+        if not records:
+            return
+        with self._locked():
+            self._append(records)
+
+    # Re-read entries other processes added
+    def refresh(self):
+        with self._locked(exclusive=False):
+            self._refresh()
+
+    # Ids whose reason is one of reasons
+    def with_reason(self, *reasons):
+        found = {key for key in self._snapshot.with_reason(*reasons) if key not in self._recent}
+        found.update(self._recent.with_reason(*reasons))
+        return found
+
+    # Force journal records written so far to disk
+    def sync(self):
+        if self._journal is not None and self._unsynced:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._unsynced = 0
+
+    # Fold the journal into a fresh snapshot and start an empty journal that
+    # only carries over the live claims
+    def _compact(self):
+        atomic_write(self.groups_path, json.dumps(self._groups).encode())
+        self._write_snapshot()
+        self._journal.truncate(0)
+        now = time.time()
+        claims = [{'id': key, 'claim': owner, 'time': claimed}
+                  for key, (owner, claimed) in self._claims.items() if now - claimed < self.claim_ttl]
+        data = b''.join(json.dumps(record).encode() + b'\n' for record in claims)
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._claims = {record['id']: (record['claim'], record['time']) for record in claims}
+        self._journal_offset = len(data)
+        self._journal_records = len(claims)
+        self._unsynced = 0
+
+    def compact(self):
+        with self._locked():
+            self._refresh(repair=True)
+            self._compact()
+
+    def close(self):
+        if self._journal is not None:
+            self.sync()
+            self._journal.close()
+            self._journal = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._snapshot.close()
+
+
+class SqliteIds(Mapping):
+    """ Read-only dict view of the latest reason per id in a SqliteCache """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, key):
+        row = self.store.db.execute('SELECT reason FROM latest WHERE namespace = ? AND id = ?',
+                                    (self.store.namespace, int(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return intern_reason(row[0])
+
+    def __contains__(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError):
+            return False
+        return self.store.db.execute('SELECT 1 FROM latest WHERE namespace = ? AND id = ?',
+                                     (self.store.namespace, key)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.store.db.execute('SELECT id FROM latest WHERE namespace = ?', (self.store.namespace,)):
+            yield row[0]
+
+    def __len__(self):
+        return self.store.db.execute('SELECT COUNT(*) FROM latest WHERE namespace = ?',
+                                     (self.store.namespace,)).fetchone()[0]
+
+
+class SqliteCache:
+    """ Cache backed by a SQLite database
+
+    Every decision is kept in `decisions` with its format and timestamp, the
+    most recent one per id in `latest`. Both tables are indexed by reason.
+    A namespace separates torrent ids from request ids so redactedbetter.py and
+    uchicago_requestmatch.py can share one database file.
+
+    SQLite's own locking makes the store safe for concurrent processes on one
+    host; claims live in their own table. SQLite is not safe on network file
+    systems, use the journal backed Cache for a cache shared over NFS.
+    """
+    suffixes = ('.sqlite', '.sqlite3', '.db')
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS decisions (
+            namespace TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            format TEXT,
+            time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS decisions_id ON decisions (namespace, id);
+        CREATE INDEX IF NOT EXISTS decisions_reason ON decisions (namespace, reason);
+        CREATE TABLE IF NOT EXISTS latest (
+            namespace TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            format TEXT,
+            time REAL NOT NULL,
+            PRIMARY KEY (namespace, id)
+        );
+        CREATE INDEX IF NOT EXISTS latest_reason ON latest (namespace, reason);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            namespace TEXT NOT NULL,
+            group_id INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            time REAL NOT NULL,
+            PRIMARY KEY (namespace, group_id)
+        );
+        CREATE TABLE IF NOT EXISTS claims (
+            namespace TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            owner TEXT NOT NULL,
+            time REAL NOT NULL,
+            PRIMARY KEY (namespace, id)
+        );
+    '''
+
+    def __init__(self, cache_path, namespace='torrent', claim_ttl=6 * 60 * 60):
+        self.cache_path = Path(cache_path)
+        self.namespace = namespace
+        self.claim_ttl = claim_ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # BufferedCache flushes from its own thread and serialises access itself
+        self.db = sqlite3.connect(str(self.cache_path), check_same_thread=False, timeout=60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(self.schema)
+        self.ids = SqliteIds(self)
+
+    def add(self, torrent_id, reason: str, format: str = None):
+        now = time.time()
+        row = (self.namespace, int(torrent_id), reason, format, now)
+        with self.db:
+            self.db.execute('INSERT INTO decisions (namespace, id, reason, format, time) VALUES (?, ?, ?, ?, ?)', row)
+            self.db.execute('INSERT OR REPLACE INTO latest (namespace, id, reason, format, time) VALUES (?, ?, ?, ?, ?)', row)
+            self.db.execute('DELETE FROM claims WHERE namespace = ? AND id = ?', row[:2])
+
+    # Group commit: store all (id, reason, format) entries in one transaction
+    def add_many(self, entries):
+        now = time.time()
+        rows = [(self.namespace, int(torrent_id), reason, format, now) for torrent_id, reason, format in entries]
+        with self.db:
+            self.db.executemany('INSERT INTO decisions (namespace, id, reason, format, time) VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO latest (namespace, id, reason, format, time) VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM claims WHERE namespace = ? AND id = ?', [row[:2] for row in rows])
+
+    def claim(self, torrent_id, retry=False):
+        """ Reserve torrent_id for this process, see Cache.claim """
+        key = (self.namespace, int(torrent_id))
+        with self.db:
+            # Take the write lock up front so check and insert are atomic
+            self.db.execute('BEGIN IMMEDIATE')
+            if not retry and self.db.execute('SELECT 1 FROM latest WHERE namespace = ? AND id = ?', key).fetchone():
+                return False
+            row = self.db.execute('SELECT owner, time FROM claims WHERE namespace = ? AND id = ?', key).fetchone()
+            if row is not None and row[0] != self.owner and time.time() - row[1] < self.claim_ttl:
+                return False
+            self.db.execute('INSERT OR REPLACE INTO claims (namespace, id, owner, time) VALUES (?, ?, ?, ?)',
+                            (*key, self.owner, time.time()))
+        return True
+
+    def release(self, torrent_id):
+        self.release_many([torrent_id])
+
+    def release_many(self, torrent_ids):
+        with self.db:
+            self.db.executemany('DELETE FROM claims WHERE namespace = ? AND id = ? AND owner = ?',
+                                [(self.namespace, int(torrent_id), self.owner) for torrent_id in torrent_ids])
+
+    # (group fingerprint, time recorded) stored for a torrent id, or None
+    def fingerprint(self, torrent_id):
+        return self.db.execute('SELECT fingerprint, time FROM fingerprints WHERE namespace = ? AND group_id = ?',
+                               (self.namespace, int(torrent_id))).fetchone()
+
+    def set_fingerprint(self, torrent_id, fingerprint: str):
+        self.set_fingerprints([(torrent_id, fingerprint, time.time())])
+
+    # Record several (torrent id, fingerprint, time) entries in one transaction
+    def set_fingerprints(self, entries):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO fingerprints (namespace, group_id, fingerprint, time) VALUES (?, ?, ?, ?)',
+                                [(self.namespace, int(torrent_id), fingerprint, recorded) for torrent_id, fingerprint, recorded in entries])
+
+    # Every query already sees other processes' commits
+    def refresh(self):
+        pass
+
+    # Ids whose latest decision is one of reasons
+    def with_reason(self, *reasons):
+        if not reasons:
+            return set()
+        placeholders = ', '.join('?' * len(reasons))
+        rows = self.db.execute(f'SELECT id FROM latest WHERE namespace = ? AND reason IN ({placeholders})',
+                               (self.namespace, *reasons))
+        return {row[0] for row in rows}
+
+    # All decisions for an id as (reason, format, time), oldest first
+    def history(self, torrent_id):
+        return self.db.execute('SELECT reason, format, time FROM decisions WHERE namespace = ? AND id = ? ORDER BY time',
+                               (self.namespace, int(torrent_id))).fetchall()
+
+    def sync(self):
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+class BufferedIds(Mapping):
+    """ Dict view of a BufferedCache: entries not yet flushed, then the store """
+
+    def __init__(self, buffered):
+        self.buffered = buffered
+
+    def __getitem__(self, key):
+        for pending in (self.buffered._pending, self.buffered._flushing):
+            if key in pending:
+                return pending[key][0]
+        with self.buffered._store_lock:
+            return self.buffered.store.ids[key]
+
+    def __contains__(self, key):
+        if key in self.buffered._pending or key in self.buffered._flushing:
+            return True
+        with self.buffered._store_lock:
+            return key in self.buffered.store.ids
+
+    def __iter__(self):
+        self.buffered.flush()
+        with self.buffered._store_lock:
+            keys = list(self.buffered.store.ids)
+        return iter(keys)
+
+    def __len__(self):
+        self.buffered.flush()
+        with self.buffered._store_lock:
+            return len(self.buffered.store.ids)
+
+
+class BufferedCache:
+    """ Group-commit wrapper around a cache store (Cache or SqliteCache)
+
+    add(), release() and set_fingerprint() only record the entry in memory. A
+    background thread hands pending entries to the store with add_many(),
+    release_many() and set_fingerprints() once `flush_every` entries are
+    pending or `flush_interval` seconds have passed, and close() and
+    interpreter exit flush whatever is left (scripts turn SIGTERM into a normal
+    exit for this). A batch the store fails to take goes back to the pending
+    entries and is tried again on the next flush. A kill -9 loses at most the
+    entries added since the last flush; a lost release only delays the claim
+    until it expires.
+    """
+
+    def __init__(self, store, flush_every=32, flush_interval=5.0):
+        self.store = store
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.ids = BufferedIds(self)
+        self._pending = {}
+        self._flushing = {}
+        self._releases = set()
+        self._fingerprints = {}
+        self._flushing_fingerprints = {}
+        self._lock = threading.Lock()
+        self._store_lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run, name='cache-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The batch is pending again, keep the thread alive to retry it
+                logger.error(f'Writing {len(self._pending)} cache entries failed, retrying in {self.flush_interval}s: {e}')
+
+    def add(self, torrent_id, reason: str, format: str = None):
+        with self._lock:
+            # Re-adding an id moves it to the end so flush order follows add order
+            self._pending.pop(torrent_id, None)
+            self._pending[torrent_id] = (reason, format)
+            pending = len(self._pending)
+        if pending >= self.flush_every:
+            self._wakeup.set()
+
+    # Hand all pending entries to the store in one group commit
+    def flush(self):
+        with self._store_lock:
+            with self._lock:
+                if not (self._pending or self._releases or self._fingerprints):
+                    return
+                self._flushing, self._pending = self._pending, {}
+                releases, self._releases = self._releases, set()
+                self._flushing_fingerprints, self._fingerprints = self._fingerprints, {}
+            try:
+                if self._flushing:
+                    self.store.add_many((key, reason, format) for key, (reason, format) in self._flushing.items())
+                    self._flushing = {}
+                # Decisions went first, they end their claims on their own
+                if releases:
+                    self.store.release_many(releases)
+                    releases = set()
+                if self._flushing_fingerprints:
+                    self.store.set_fingerprints((torrent_id, fingerprint, recorded) for torrent_id, (fingerprint, recorded)
+                                                in self._flushing_fingerprints.items())
+                    self._flushing_fingerprints = {}
+            except Exception:
+                with self._lock:
+                    # Entries added since the batch was taken are newer, they win
+                    failed, self._flushing = self._flushing, {}
+                    for key in self._pending:
+                        failed.pop(key, None)
+                    failed.update(self._pending)
+                    self._pending = failed
+                    self._releases |= releases
+                    failed, self._flushing_fingerprints = self._flushing_fingerprints, {}
+                    failed.update(self._fingerprints)
+                    self._fingerprints = failed
+                raise
+
+    def with_reason(self, *reasons):
+        self.flush()
+        with self._store_lock:
+            return self.store.with_reason(*reasons)
+
+    # Claims must be visible to other processes at once, so they bypass the buffer
+    def claim(self, torrent_id, retry=False):
+        with self._lock:
+            decided = torrent_id in self._pending or torrent_id in self._flushing
+            if decided and not retry:
+                return False
+            # The store still holds our claim, dropping the release keeps it
+            self._releases.discard(torrent_id)
+        if decided:
+            # The pending decision would end the new claim when it is flushed
+            self.flush()
+        with self._store_lock:
+            return self.store.claim(torrent_id, retry)
+
+    # Other processes only need a release eventually, claims expire anyway
+    def release(self, torrent_id):
+        with self._lock:
+            self._releases.add(torrent_id)
+
+    def refresh(self):
+        with self._store_lock:
+            self.store.refresh()
+
+    def fingerprint(self, torrent_id):
+        torrent_id = int(torrent_id)
+        with self._lock:
+            for pending in (self._fingerprints, self._flushing_fingerprints):
+                if torrent_id in pending:
+                    return pending[torrent_id]
+        with self._store_lock:
+            return self.store.fingerprint(torrent_id)
+
+    def set_fingerprint(self, torrent_id, fingerprint: str):
+        with self._lock:
+            self._fingerprints[int(torrent_id)] = (fingerprint, time.time())
+
+    def sync(self):
+        self.flush()
+        with self._store_lock:
+            self.store.sync()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+        with self._store_lock:
+            self.store.close()
+        atexit.unregister(self.close)
+
+    # Anything else (history, compact, ...) goes straight to the store
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+class ResponseCache:
+    """ Persistent cache of successful ajax.php responses
+
+    Responses are keyed by a hash of the `account` credentials (the api key),
+    action and parameters and served for `ttls[action]` seconds, so a changed
+    key never sees another account's responses. Actions without a ttl are
+    never cached: upload, download, ... and index, which is what checks that
+    the key is still valid. RedactedAPI.request consults it before spending a
+    rate limited call.
+    """
+    ttls = {'torrentgroup': 30 * 60,
+            'torrent': 30 * 60,
+            'user_torrents': 10 * 60,
+            'requests': 5 * 60,
+            'notifications': 60}
+
+    def __init__(self, cache_path, ttls=None, account=''):
+        self.cache_path = Path(cache_path)
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self.account = hashlib.sha256(str(account or '').encode()).hexdigest()[:16]
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.cache_path), check_same_thread=False, timeout=60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, action TEXT NOT NULL, '
+                        'response TEXT NOT NULL, time REAL NOT NULL)')
+        self._lock = threading.Lock()
+        # Nothing outlives the longest ttl, drop it so the file does not grow forever
+        with self.db:
+            self.db.execute('DELETE FROM responses WHERE time < ?', (time.time() - max(self.ttls.values()),))
+
+    def key(self, action, params):
+        return json.dumps([self.account, action, {name: str(value) for name, value in params.items()}], sort_keys=True)
+
+    def get(self, action, params):
+        ttl = self.ttls.get(action)
+        if not ttl:
+            return None
+        with self._lock:
+            row = self.db.execute('SELECT response, time FROM responses WHERE key = ?', (self.key(action, params),)).fetchone()
+        if row is None or time.time() - row[1] >= ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, action, params, response):
+        if not self.ttls.get(action):
+            return
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses (key, action, response, time) VALUES (?, ?, ?, ?)',
+                            (self.key(action, params), action, json.dumps(response), time.time()))
+
+    # Forget a cached response, e.g. a torrent group we just uploaded to
+    def invalidate(self, action, **params):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (self.key(action, params),))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def open_cache(location, namespace='torrent'):
+    """ Open the cache store at location
+
+    `sqlite:<path>` or a path ending in one of SqliteCache.suffixes selects the
+    SQLite backend, anything else the journal backed Cache.
+    """
+    location = str(location)
+    if location.startswith('sqlite:'):
+        return SqliteCache(Path(location[len('sqlite:'):]).expanduser(), namespace)
+    if Path(location).suffix.lower() in SqliteCache.suffixes:
+        return SqliteCache(Path(location).expanduser(), namespace)
+    return Cache(Path(location).expanduser())
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
+import bisect
+import collections
+import concurrent.futures
+import hashlib
 import re
 import json
+import os
+import queue
+import random
+import threading
 import time
 import requests
+from urllib3.exceptions import NewConnectionError
 from utils import Utilities
 from static import Static
 import logging
@@ -35,9 +44,231 @@ class RequestException(Exception):
     pass
 
 
+class TransientRequestException(RequestException):
+    '''Connection problems, 5xx and non-JSON pages (Cloudflare, maintenance): worth retrying'''
+    pass
+
+
+class RateLimitedException(TransientRequestException):
+    '''The site asked us to slow down'''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AuthException(RequestException, LoginException):
+    '''The api key was rejected, retrying will not help'''
+    pass
+
+
+class RetryPolicy:
+    '''
+    Exponential backoff with full jitter for transient request errors:
+    attempt n waits a random time up to min(cap, base * 2 ** n) seconds, at most `retries` times.
+    '''
+    def __init__(self, retries=5, base=2.0, cap=120.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, error):
+        '''Seconds to wait before retrying after `error`, None when out of retries'''
+        if attempt >= self.retries:
+            return None
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if isinstance(error, RateLimitedException) and error.retry_after:
+            delay = max(delay, error.retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    '''
+    Opens after `threshold` consecutive transient failures. While open, every request first
+    waits out the cooldown instead of hammering a site that is down; the cooldown doubles
+    (up to max_cooldown) each time the breaker trips again before a request succeeds.
+    A request that had to wait starts its retry count over, so an outage pauses an
+    unattended run until the site is back instead of ending it.
+    '''
+    def __init__(self, threshold=5, cooldown=60.0, max_cooldown=30 * 60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.trips = 0
+        self._failures = 0
+        self._next_cooldown = cooldown
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        '''Seconds until requests may be made again'''
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self):
+        '''Sleep while the breaker is open, returns the seconds slept'''
+        delay = self.delay()
+        if delay > 0:
+            logger.warning(f'Site looks unavailable, pausing requests for {delay:.0f}s')
+            time.sleep(delay)
+        return delay
+
+    def failure(self):
+        '''Count a transient failure, returns True if it opened the breaker'''
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return False
+            self._open_until = time.monotonic() + self._next_cooldown
+            self._next_cooldown = min(2 * self._next_cooldown, self.max_cooldown)
+            self._failures = 0
+            self.trips += 1
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._next_cooldown = self.cooldown
+
+
+class RateLimiter:
+    '''
+    Token bucket holding `burst` tokens where a spent token comes back `window` seconds later,
+    which is exactly the site's "at most `burst` requests per `window` seconds".
+    Callers reserve a slot and sleep once until it starts instead of polling; the limiter is
+    thread safe so every request path (and later worker threads) can share one instance.
+    '''
+    def __init__(self, burst=10, window=10.0):
+        self.burst = burst
+        self.window = window
+        self.waited = 0.0  # total seconds callers were delayed
+        self.waits = 0     # number of delayed calls
+        self._slots = collections.deque(maxlen=burst)
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        '''Take a token and return how many seconds to wait before using it'''
+        with self._lock:
+            now = time.monotonic()
+            slot = now
+            if len(self._slots) == self.burst:
+                slot = max(now, self._slots[0] + self.window)
+            self._slots.append(slot)
+            delay = slot - now
+            if delay > 0:
+                self.waited += delay
+                self.waits += 1
+            return delay
+
+    def acquire(self):
+        '''Block until a request may be made, returns the seconds waited'''
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class ApiStats:
+    '''
+    Per-action request counters: calls, response cache hits, bytes received, seconds spent
+    waiting for the rate limiter and on the network (with a latency histogram), retries and
+    errors by kind. Thread safe, worker threads record into the same one.
+    '''
+    buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # histogram upper bounds, seconds
+
+    def __init__(self):
+        self.started = time.time()
+        self._actions = {}
+        self._lock = threading.Lock()
+
+    def _action(self, action):
+        if action not in self._actions:
+            self._actions[action] = {'calls': 0, 'cache_hits': 0, 'bytes': 0, 'latency': 0.0, 'max_latency': 0.0,
+                                     'histogram': [0] * (len(self.buckets) + 1), 'limiter_wait': 0.0,
+                                     'retries': 0, 'errors': {}}
+        return self._actions[action]
+
+    def request(self, action, latency, size):
+        with self._lock:
+            stats = self._action(action)
+            stats['calls'] += 1
+            stats['bytes'] += size
+            stats['latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['histogram'][bisect.bisect_left(self.buckets, latency)] += 1
+
+    def cache_hit(self, action):
+        with self._lock:
+            self._action(action)['cache_hits'] += 1
+
+    def waited(self, action, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._action(action)['limiter_wait'] += seconds
+
+    def retry(self, action):
+        with self._lock:
+            self._action(action)['retries'] += 1
+
+    def error(self, action, error):
+        '''Count an error: an exception, or a string for api failures that don't raise'''
+        if isinstance(error, RateLimitedException):
+            kind = 'rate_limited'
+        elif isinstance(error, AuthException):
+            kind = 'auth'
+        elif isinstance(error, TransientRequestException):
+            kind = 'transient'
+        elif isinstance(error, Exception):
+            kind = type(error).__name__
+        else:
+            kind = error
+        with self._lock:
+            errors = self._action(action)['errors']
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def percentile(self, histogram, fraction):
+        '''Upper bound of the histogram bucket holding the given fraction of calls'''
+        target = fraction * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), histogram):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+    def as_dict(self):
+        with self._lock:
+            actions = {action: dict(stats, histogram=list(stats['histogram']), errors=dict(stats['errors']))
+                       for action, stats in self._actions.items()}
+        for stats in actions.values():
+            stats['mean_latency'] = stats['latency'] / stats['calls'] if stats['calls'] else 0.0
+            stats['p50_latency'] = self.percentile(stats['histogram'], 0.5)
+            stats['p95_latency'] = self.percentile(stats['histogram'], 0.95)
+        return {'started': self.started, 'elapsed': time.time() - self.started,
+                'buckets': list(self.buckets), 'actions': actions}
+
+    def report(self):
+        '''The counters as a table, one line per action'''
+        stats = self.as_dict()
+        lines = [f'API usage over {stats["elapsed"]:.0f}s:',
+                 f'{"action":<14}{"calls":>7}{"cached":>8}{"MiB":>8}{"net s":>9}{"mean":>7}{"p95":>7}'
+                 f'{"limit s":>9}{"retries":>8}  errors']
+        for action, action_stats in sorted(stats['actions'].items()):
+            errors = ', '.join(f'{kind} {count}' for kind, count in sorted(action_stats['errors'].items()))
+            lines.append(f'{action:<14}{action_stats["calls"]:>7}{action_stats["cache_hits"]:>8}'
+                         f'{action_stats["bytes"] / 2 ** 20:>8.1f}{action_stats["latency"]:>9.1f}'
+                         f'{action_stats["mean_latency"]:>7.2f}{action_stats["p95_latency"]:>7.2f}'
+                         f'{action_stats["limiter_wait"]:>9.1f}{action_stats["retries"]:>8}  {errors}')
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        with open(path, 'w') as stats_file:
+            json.dump(self.as_dict(), stats_file, indent=1)
+
+
 class RedactedAPI:
-    def __init__(self, page_size, api_key, sparse=False):
-        self.session = requests.Session()
+    def __init__(self, page_size, api_key, sparse=False, limiter=None, response_cache=None, retry=None, breaker=None,
+                 mainpage='https://redacted.ch/'):
+        self._local = threading.local()
         self.headers = {
             'Connection': 'keep-alive',
             'Cache-Control': 'max-age=0',
@@ -47,17 +278,32 @@ class RedactedAPI:
             'Accept-Language': 'en-US,en;q=0.8',
             'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
             'Authorization': f'{api_key}'}
-        self.session.headers.update(self.headers)
         self.page_size = page_size
         self.api_key_authenticated = False
         self.tracker = "https://flacsfor.me/"
-        self.last_request = time.time()
-        self.rate_limit = 1.0  # seconds between requests
-        self.mainpage = "https://redacted.ch/"
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.response_cache = response_cache
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.stats = ApiStats()
+        # apiTorrentGroup objects fetched this run, most recently used last
+        self.torrentgroups = collections.OrderedDict()
+        self.torrentgroups_size = 512
+        self._torrentgroups_lock = threading.Lock()
+        self.mainpage = mainpage
         self.accountinfo = None
         self.sparse = sparse
         self._test_session()
 
+    # One requests.Session per thread, read_ahead() and the prefetch call the api from their own
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(self.headers)
+        return session
+
     # using only api login method, other methods not needed
     def _test_session(self):
         try:
@@ -80,26 +326,114 @@ class RedactedAPI:
         else:
             raise LoginException
 
-    def request(self, action, passthrough=False, **kwargs):
-        '''Makes an AJAX request at a given action page'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
+    def request(self, action, passthrough=False, fresh=False, **kwargs):
+        '''Makes an AJAX request at a given action page, fresh skips the response cache'''
+        return self._request(self.session, action, kwargs, passthrough, fresh)
+
+    # request() on a given session, for worker threads that each have their own
+    def _request(self, session, action, kwargs, passthrough=False, fresh=False):
+        if not passthrough and not fresh:
+            cached = self._cached_response(action, kwargs)
+            if cached is not None:
+                return cached
+
+        def send():
+            r = self._get(session, action, kwargs)
+            if passthrough:
+                self._check_status(r)
+                return r.content
+            return self._parse(action, kwargs, r)
+        return self._with_retries(action, send)
 
+    # Run send() behind the circuit breaker and rate limiter, retrying transient errors
+    def _with_retries(self, action, send):
+        attempt = 0
+        while True:
+            if self.breaker.wait():
+                # The retries are for blips, waiting out an outage doesn't use them up
+                attempt = 0
+            self.stats.waited(action, self.limiter.acquire())
+            try:
+                result = send()
+            except TransientRequestException as e:
+                self.stats.error(action, e)
+                if not isinstance(e, RateLimitedException) and self.breaker.failure():
+                    logger.warning(f'Request {action} failed ({e}), the site looks down')
+                    self.stats.retry(action)
+                    continue
+                delay = self.retry.delay(attempt, e)
+                if delay is None:
+                    raise
+                logger.warning(f'Request {action} failed ({e}), retrying in {delay:.1f}s')
+                self.stats.retry(action)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except AuthException as e:
+                self.stats.error(action, e)
+                raise
+            self.breaker.success()
+            return result
+
+    # The pieces of request()
+    def _cached_response(self, action, kwargs):
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.get(action, kwargs)
+        if cached is not None:
+            self.stats.cache_hit(action)
+        return cached
+
+    def _get(self, session, action, kwargs):
         ajaxpage = f'{self.mainpage}ajax.php'
         params = {'action': action}
         params.update(kwargs)
-        r = self.session.get(ajaxpage, params=params, allow_redirects=False)
-        self.last_request = time.time()
-        if passthrough:
-            return r.content
+        start = time.monotonic()
+        try:
+            r = session.get(ajaxpage, params=params, allow_redirects=False)
+        except requests.exceptions.RequestException as e:
+            raise TransientRequestException(e)
+        self.stats.request(action, time.monotonic() - start, len(r.content))
+        return r
+
+    # True if a requests error means the request never reached the site
+    @staticmethod
+    def _not_sent(e):
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+    # Raise the matching RequestException for a response that is an error by its HTTP status
+    @staticmethod
+    def _check_status(r):
+        if r.status_code == 429:
+            retry_after = r.headers.get('Retry-After', '')
+            raise RateLimitedException('HTTP 429', float(retry_after) if retry_after.isdigit() else None)
+        if r.status_code in (401, 403) or 300 <= r.status_code < 400:
+            # ajax.php redirects to the login page when the key is not accepted
+            raise AuthException(f'HTTP {r.status_code}')
+        if r.status_code >= 500:
+            raise TransientRequestException(f'HTTP {r.status_code}')
+
+    # Returns the response, or None for a permanent failure such as a bad id
+    def _parse(self, action, kwargs, r):
+        self._check_status(r)
         try:
             parsed = json.loads(r.content)
-            if parsed['status'] != 'success':
-                return None
-            else:
-                return parsed['response']
         except ValueError as e:
-            raise RequestException(e)
+            # Cloudflare and maintenance pages are HTML
+            raise TransientRequestException(f'non-JSON response: {e}')
+        if parsed['status'] != 'success':
+            error = str(parsed.get('error', ''))
+            if 'rate limit' in error.lower():
+                raise RateLimitedException(error)
+            if 'credentials' in error.lower() or 'api key' in error.lower():
+                raise AuthException(error)
+            logger.debug(f'Request {action} {kwargs} failed: {error}')
+            self.stats.error(action, 'failed')
+            return None
+        if self.response_cache is not None:
+            self.response_cache.put(action, kwargs, parsed['response'])
+        return parsed['response']
 
     # def get_artist(self, id=None, format='MP3', best_seeded=True):
     #     res = self.request('artist', id=id)
@@ -136,12 +470,16 @@ class RedactedAPI:
         if self.api_key_authenticated:
             page = 0
             while True:
-                torrents = usertorrents(**self.request(
+                response = self.request(
                     'user_torrents',
                     id=self.accountinfo.id,
                     type='snatched',
                     limit=self.page_size,
-                    offset=page * self.page_size))
+                    offset=page * self.page_size)
+                if response is None:
+                    logger.error(f'Could not fetch page {page}, stopping')
+                    break
+                torrents = usertorrents(**response)
                 if len(torrents.snatched) == 0:
                     break
                 for item in torrents.snatched:
@@ -151,25 +489,82 @@ class RedactedAPI:
             logger.info("Not authenticated")
             return None
 
+    # One list of (groupid, torrentid) pairs per seeding page, None if a page could not be fetched
+    def _seeding_pages(self, page=0, fresh=False):
+        while True:
+            response = self.request(
+                'user_torrents',
+                fresh=fresh,
+                id=self.accountinfo.id,
+                type='seeding',
+                limit=self.page_size,
+                offset=page * self.page_size)
+            if response is None:
+                logger.error(f'Could not fetch page {page}, stopping')
+                yield None
+                return
+            torrents = usertorrents(**response)
+            if len(torrents.seeding) == 0:
+                return
+            yield [(int(item['groupId']), int(item['torrentId'])) for item in torrents.seeding]
+            page += 1
+
     def get_seeding(self):
         if self.api_key_authenticated:
-            page = 0
-            while True:
-                torrents = usertorrents(**self.request(
-                    'user_torrents',
-                    id=self.accountinfo.id,
-                    type='seeding',
-                    limit=self.page_size,
-                    offset=page * self.page_size))
-                if len(torrents.seeding) == 0:
+            for pairs in self._seeding_pages():
+                if pairs is None:
                     break
-                for item in torrents.seeding:
-                    yield int(item['groupId']), int(item['torrentId'])
-                page += 1
+                yield from pairs
         else:
             logger.info("Not authenticated")
             return None
 
+    def get_seeding_count(self):
+        '''Number of torrents seeded according to the user profile, None if paranoia hides it'''
+        response = self.request('user', id=self.accountinfo.id)
+        if response is None:
+            return None
+        seeding = response.get('community', {}).get('seeding')
+        return int(seeding) if seeding is not None else None
+
+    def sync_seeding(self, previous):
+        '''
+        Brings a previous seeding list up to date and returns the current one, or None if a page
+        could not be fetched. The list is ordered newest first, so paging stops at the first page
+        made up of known torrents only and the rest is taken from previous. When the profile's
+        seeding count says that doesn't add up (torrents were removed, or the order changed) the
+        whole list is walked after all. The count can't tell N removed and N added torrents from
+        no removals, those stale entries stay until a full walk (sync_seeding([])). The pages
+        bypass the response cache, a cached first page would hide the newest torrents.
+        '''
+        if not self.api_key_authenticated:
+            logger.info("Not authenticated")
+            return None
+        known = {torrentid for _, torrentid in previous}
+        fetched = []
+        pages = self._seeding_pages(fresh=True)
+        for count, pairs in enumerate(pages, 1):
+            if pairs is None:
+                return None
+            fetched.extend(pairs)
+            if known and all(torrentid in known for _, torrentid in pairs):
+                break
+        else:
+            logger.debug(f'Walked the whole seeding list, {len(fetched)} torrents')
+            return fetched
+        seen = {torrentid for _, torrentid in fetched}
+        current = fetched + [pair for pair in previous if pair[1] not in seen]
+        seeding = self.get_seeding_count()
+        if seeding is None or seeding == len(current):
+            logger.debug(f'Seeding list synced after {count} pages')
+            return current
+        logger.info(f'Profile says {seeding} torrents seeding, snapshot has {len(current)}, walking the whole list')
+        for pairs in pages:
+            if pairs is None:
+                return None
+            fetched.extend(pairs)
+        return fetched
+
     # def get_torrentgroup(self, groupid):
     #     if self.api_key_authenticated:
     #         tgroup = torrentgroup(**self.request('torrentgroup', id=groupid))
@@ -181,37 +576,95 @@ class RedactedAPI:
 
     def get_api_torrentgroup(self, groupid):
         if self.api_key_authenticated:
-            response = self.request('torrentgroup', id=groupid)
-            if response and 'group' in response:
-                tgroup = apiTorrentGroup(**response['group'])
-                for torrent in response['torrents']:
-                    tgroup.torrents.append(apiTorrent(**torrent))
+            tgroup = self._recall_torrentgroup(groupid)
+            if tgroup is not None:
                 return tgroup
+            return self._remember_torrentgroup(groupid, self.request('torrentgroup', id=groupid))
         else:
             logger.info("Not authenticated")
             return None
 
+    def _recall_torrentgroup(self, groupid):
+        with self._torrentgroups_lock:
+            if groupid in self.torrentgroups:
+                self.torrentgroups.move_to_end(groupid)
+                return self.torrentgroups[groupid]
+        return None
+
+    # Build an apiTorrentGroup from a torrentgroup response and keep it in the LRU
+    def _remember_torrentgroup(self, groupid, response):
+        if response and 'group' in response:
+            tgroup = apiTorrentGroup(**response['group'])
+            for torrent in response['torrents']:
+                tgroup.torrents.append(apiTorrent(**torrent))
+            with self._torrentgroups_lock:
+                self.torrentgroups[groupid] = tgroup
+                if len(self.torrentgroups) > self.torrentgroups_size:
+                    self.torrentgroups.popitem(last=False)
+            return tgroup
+        return None
+
+    def forget_torrentgroup(self, groupid):
+        with self._torrentgroups_lock:
+            self.torrentgroups.pop(groupid, None)
+        if self.response_cache is not None:
+            self.response_cache.invalidate('torrentgroup', id=groupid)
+
+    def get_stats(self):
+        '''Per-action call counts, bytes, latencies, rate limiter waits and errors of this run so far'''
+        return self.stats.as_dict()
+
     def release_url(self, groupid, torrentid):
         return f"{self.mainpage}torrents.php?id=%s&torrentid=%s#torrent%s" % (groupid, torrentid, torrentid)
 
     def permalink(self, torrentid):
         return f"{self.mainpage}torrents.php?torrentid={torrentid}"
 
-    # TODO:     # Outdated and needs to be rewritten to api key auth
     def get_better(self, search_type=3, tags=None):
+        '''
+        Torrents the site lists as missing transcodes (better.php?method=transcode), search_type 3
+        limits the listing to torrents we seed. The response is a list of rows with torrentId and
+        downloadUrl. Returns a list of dicts with permalink, id and torrent (download url), or None
+        if the listing could not be fetched or does not look like that.
+        '''
         if tags is None:
             tags = []
         data = self.request('better', method='transcode',
                             type=search_type, search=' '.join(tags))
+        if data is None:
+            return None
         out = []
-        for row in data:
-            out.append({
-                'permalink': 'torrents.php?id={}'.format(row['torrentId']),
-                'id': row['torrentId'],
-                'torrent': row['downloadUrl'],
-            })
+        try:
+            for row in data:
+                out.append({
+                    'permalink': self.permalink(row['torrentId']),
+                    'id': int(row['torrentId']),
+                    'torrent': row['downloadUrl'],
+                })
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f'Unexpected transcode listing, expected a list of rows with torrentId and downloadUrl: '
+                         f'{type(e).__name__} {e} in {str(data)[:200]}')
+            return None
         return out
 
+    def get_transcode_candidates(self):
+        '''
+        (groupid, torrentid) pairs from the site's transcode listing that are also in our seeding
+        list, so only torrents that actually miss a format are evaluated. The seeding list costs one
+        call per page instead of one torrentgroup call per torrent. Falls back to the whole seeding
+        list when the transcode listing is unavailable.
+        '''
+        better = self.get_better()
+        if better is None:
+            logger.warning('Transcode listing unavailable, falling back to the seeding list')
+            yield from self.get_seeding()
+            return
+        seeding = {torrentid: groupid for groupid, torrentid in self.get_seeding()}
+        logger.info(f'{len(better)} torrents need transcodes, {len(seeding)} torrents seeding')
+        for row in better:
+            if row['id'] in seeding:
+                yield seeding[row['id']], row['id']
+
     def get_torrent(self, torrent_id, usetoken=False):
         # URL:ajax.php?action=download
         # Arguments
@@ -219,18 +672,17 @@ class RedactedAPI:
         # usetoken (optional) - Default: 0. Set to 1 to spend a FL token.
         # Will if fail a token cannot be spent on this torrent for any reason.
         '''Downloads the torrent at torrent_id'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
-        ajaxpage = f'{self.mainpage}ajax.php'
         if usetoken:
-            params = {'action': 'download', 'id': torrent_id, 'usetoken': 1}
+            params = {'id': torrent_id, 'usetoken': 1}
         else:
-            params = {'action': 'download', 'id': torrent_id}
-        r = self.session.get(ajaxpage, params=params,
-                             allow_redirects=False)
+            params = {'id': torrent_id}
+
+        def send():
+            r = self._get(self.session, 'download', params)
+            self._check_status(r)
+            return r
+        r = self._with_retries('download', send)
 
-        self.last_request = time.time() + 2.0
         if r.status_code == 200 and 'application/x-bittorrent' in r.headers['content-type']:
             return r.content
         return None
@@ -238,6 +690,19 @@ class RedactedAPI:
     def get_torrent_info(self, id):
         return self.request('torrent', id=id)['torrent']
 
+    # order is a requests.php sort column: bounty, created, votes, ...
+    @staticmethod
+    def requests_historical_params(page, order='bounty'):
+        return {'page': page,
+                'order': order,
+                'sort': 'desc',
+                'submit': 'true',
+                'showall': 'on',
+                'media_strict': 'on',
+                'media[0]': 0,
+                'filter_cat[1]': 1
+                }
+
     def get_requests_historical(self, start_page=0, end_page=1):
         """
         https://redacted.ch/requests.php?order=bounty&sort=desc&submit=true&search=&tags=&tags_type=1&showall=on&releases%5B0%5D=1
@@ -248,32 +713,7 @@ class RedactedAPI:
         &bitrates%5B9%5D=9&bitrates%5B10%5D=10&media_strict=on&media%5B0%5D=0
         """
         def quickndirty_request(page):
-            while time.time() - self.last_request < self.rate_limit:
-                time.sleep(0.1)
-
-            ajaxpage = f'{self.mainpage}ajax.php'
-            params = {'action': 'requests',
-                      'page': page,
-                      'order': 'bounty',
-                      'sort': 'desc',
-                      'submit': 'true',
-                      'showall': 'on',
-                      'media_strict': 'on',
-                      'media[0]': 0,
-                      'filter_cat[1]': 1
-                      }
-
-            r = self.session.get(ajaxpage, params=params,
-                                 allow_redirects=False)
-            self.last_request = time.time()
-            try:
-                parsed = json.loads(r.content)
-                if parsed['status'] != 'success':
-                    return None
-                else:
-                    return parsed['response']
-            except ValueError as e:
-                raise RequestException(e)
+            return self.request('requests', **self.requests_historical_params(page))
 
         if self.api_key_authenticated:
             page = start_page
@@ -284,7 +724,11 @@ class RedactedAPI:
                     break
                 if not self.sparse:
                     logger.info(f'Requesting page {page}')
-                requests = AJAXtoObj(**quickndirty_request(page))
+                response = quickndirty_request(page)
+                if response is None:
+                    logger.error(f'Could not fetch page {page}, stopping')
+                    break
+                requests = AJAXtoObj(**response)
                 if len(requests.results) == 0:
                     logger.info("requests.results = 0")
                     break
@@ -295,6 +739,62 @@ class RedactedAPI:
             logger.info("Not authenticated")
             return None
 
+    def get_requests_historical_pages(self, start_page=0, end_page=1, concurrency=4, ordered=True, order='bounty'):
+        '''
+        (page, results) for the historical requests pages start_page..end_page, sorted by `order`
+        (descending), fetched up to `concurrency` at a time on worker threads that share the rate
+        limiter. Pages are yielded in page order, or as soon as they arrive with ordered=False.
+        No page is fetched past the first empty or failed one. In page order nothing past it is
+        yielded either; unordered, later pages that arrived before it already have been.
+        Closing the generator cancels the pages not fetched yet.
+        '''
+        if not self.api_key_authenticated:
+            logger.info("Not authenticated")
+            return
+
+        def fetch(page):
+            if not self.sparse:
+                logger.info(f'Requesting page {page}')
+            return self.request('requests', **self.requests_historical_params(page, order))
+
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix='requests-pages')
+        pending = {}
+        arrived = {}
+        next_page = expected = start_page
+        last_page = end_page
+        try:
+            while True:
+                while len(pending) < concurrency and next_page <= last_page:
+                    pending[executor.submit(fetch, next_page)] = next_page
+                    next_page += 1
+                if not pending:
+                    break
+                finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    page = pending.pop(future)
+                    response = future.result()
+                    if response is None:
+                        logger.error(f'Could not fetch page {page}, stopping')
+                    elif len(response['results']) == 0:
+                        logger.info("requests.results = 0")
+                    else:
+                        arrived[page] = response['results']
+                        continue
+                    last_page = min(last_page, page - 1)
+                if ordered:
+                    while expected in arrived and expected <= last_page:
+                        yield expected, arrived.pop(expected)
+                        expected += 1
+                else:
+                    for page in sorted(arrived):
+                        results = arrived.pop(page)
+                        if page <= last_page:
+                            yield page, results
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
     def get_requests(self, start_page=0, end_page=1):
         """    Requests Search
         URL:ajax.php?action=requests&search=<term>&page=<page>&tag=<tags>
@@ -383,8 +883,12 @@ class RedactedAPI:
             while True:
                 if page >= end_page:
                     break
-                requests = AJAXtoObj(**self.request(
-                    'requests', page=page))
+                response = self.request(
+                    'requests', page=page)
+                if response is None:
+                    logger.error(f'Could not fetch page {page}, stopping')
+                    break
+                requests = AJAXtoObj(**response)
                 if len(requests.results) == 0:
                     logger.info("requests.results = 0")
                     break
@@ -465,7 +969,8 @@ class RedactedAPI:
             bitrate = 'Lossless'
             vbr = 'false'
 
-        files = {"file_input": open(new_torrent, 'rb')}
+        with open(new_torrent, 'rb') as f:
+            files = {"file_input": (os.path.basename(new_torrent), f.read())}
         params = {'action': 'upload',
                   'type': 0,
                   'artists[]': group.musicInfo['artists'][0]['name'],
@@ -482,14 +987,24 @@ class RedactedAPI:
                   'release_desc': description,
                   'groupid': group.id}
         logger.debug(params)
-        # Upload torrent using api key
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
         ajaxpage = f'{self.mainpage}ajax.php?action=upload'
 
-        r = self.session.post(ajaxpage, files=files, data=params)
-        self.last_request = time.time()
+        # Upload torrent using api key. Only retried when the connection could not be made: a
+        # request that was sent and then failed may still have created the torrent, and
+        # uploading it twice is worse than failing.
+        def send():
+            start = time.monotonic()
+            try:
+                r = self.session.post(ajaxpage, files=files, data=params)
+            except requests.exceptions.RequestException as e:
+                if self._not_sent(e):
+                    raise TransientRequestException(e)
+                raise RequestException(e)
+            self.stats.request('upload', time.monotonic() - start, len(r.content))
+            return r
+        r = self._with_retries('upload', send)
+        # The group has a new torrent now
+        self.forget_torrentgroup(group.id)
         try:
             parsed = json.loads(r.content)
             if parsed['status']:
@@ -513,8 +1028,12 @@ class RedactedAPI:
             while True:
                 if page >= end_page:
                     break
-                requests = AJAXtoObj(**self.request(
-                    'notifications', page=page))
+                response = self.request(
+                    'notifications', page=page)
+                if response is None:
+                    logger.error(f'Could not fetch page {page}, stopping')
+                    break
+                requests = AJAXtoObj(**response)
                 if len(requests.results) == 0:
                     logger.info("requests.results = 0")
                     break
@@ -526,6 +1045,85 @@ class RedactedAPI:
             return None
 
 
+def read_ahead(iterable, size):
+    '''
+    Yields the items of iterable while a background thread keeps up to `size` further
+    items produced ahead of the consumer. Exceptions in the producer are re-raised here.
+    '''
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+
+    producer = threading.Thread(target=produce, name='read-ahead', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def prefetch_torrentgroups(api, candidates, wanted, size, unwanted=None):
+    '''
+    Passes (groupid, torrentid) candidates through while fetching the torrent groups of the
+    next `size` wanted ones into the api's LRU in the background, so that
+    api.get_api_torrentgroup() is answered from memory when the main loop gets there.
+    wanted(groupid, torrentid) keeps groups of candidates that will be skipped from being fetched.
+    When the generator is closed early, unwanted(groupid, torrentid) is called for the wanted
+    candidates that were never passed on, to give back what wanted() reserved for them.
+    '''
+    lock = threading.Lock()
+    ahead = collections.deque()  # wanted candidates not passed on yet, in order
+    closed = False
+
+    def fetch():
+        for groupid, torrentid in candidates:
+            with lock:
+                if closed:
+                    return
+                fetching = wanted(groupid, torrentid)
+                if fetching:
+                    ahead.append((groupid, torrentid))
+            if fetching:
+                api.get_api_torrentgroup(groupid)
+            yield groupid, torrentid
+
+    items = read_ahead(fetch(), size)
+    try:
+        for item in items:
+            with lock:
+                if ahead and ahead[0] == item:
+                    ahead.popleft()
+            yield item
+    finally:
+        items.close()
+        with lock:
+            closed = True
+        if unwanted is not None:
+            for groupid, torrentid in ahead:
+                unwanted(groupid, torrentid)
+
+
 class AJAXtoObj:
     def __init__(self, **entries):
         self.__dict__.update(entries)
@@ -542,69 +1140,74 @@ class usertorrents:
         self.__dict__.update(entries)
 
 
-class apiTorrent():
+class apiModel():
+    '''Slotted base for api models: known fields live in slots, anything else the api sends in _extra'''
+    __slots__ = ('_extra',)
+    _fields = ()
+
     def __init__(self, **entries):
-        self.description = None
-        self.encoding = None
-        self.fileCount = None
-        self.fileList = []
-        self.filePath = None
-        self.format = None
-        self.freeTorrent = None
-        self.hasCue = None
-        self.hasLog = None
-        self.has_snatched = None
-        self.id = None
-        self.leechers = None
-        self.logScore = None
-        self.lossyMasterApproved = None
-        self.lossyWebApproved = None
-        self.media = None
-        self.remasterCatalogueNumber = None
-        self.remasterRecordLabel = None
-        self.remasterTitle = None
-        self.remasterYear = None
-        self.remastered = None
-        self.reported = None
-        self.scene = None
-        self.seeders = None
-        self.size = None
-        self.snatched = None
-        self.time = None
-        self.trumpable = None
-        self.userId = None
-        self.username = None
-        self.__dict__.update(entries)
-        if self.fileList:
-            self.fileList = ut.split_filelist(self.fileList)
+        for field in self._fields:
+            setattr(self, field, entries.pop(field, None))
+        self._extra = entries or None
+
+    def __getattr__(self, name):
+        # Only reached when the slot lookup fails, i.e. for keys the api added after these models were written
+        try:
+            return object.__getattribute__(self, '_extra')[name]
+        except (AttributeError, KeyError, TypeError):
+            raise AttributeError(f'{type(self).__name__} has no attribute {name!r}') from None
+
 
+class apiTorrent(apiModel):
+    _fields = ('description', 'encoding', 'fileCount', 'filePath', 'format', 'freeTorrent', 'hasCue', 'hasLog',
+               'has_snatched', 'id', 'infoHash', 'isFreeload', 'isNeutralleech', 'leechers', 'logChecksum', 'logCount',
+               'logScore', 'lossyMasterApproved', 'lossyWebApproved', 'media', 'remasterCatalogueNumber',
+               'remasterRecordLabel', 'remasterTitle', 'remasterYear', 'remastered', 'reported', 'ripLogIds', 'scene',
+               'seeders', 'size', 'snatched', 'time', 'trumpable', 'userId', 'username')
+    __slots__ = _fields + ('_fileList',)
+
+    def __init__(self, fileList=None, **entries):
+        super().__init__(**entries)
+        # Raw "name{{{size}}}|||..." string, only split when fileList is first read
+        self._fileList = fileList or []
+
+    @property
+    def fileList(self):
+        if isinstance(self._fileList, str):
+            self._fileList = ut.split_filelist(self._fileList)
+        return self._fileList
+
+    @fileList.setter
+    def fileList(self, value):
+        self._fileList = value or []
+
+
+class apiTorrentGroup(apiModel):
+    _fields = ('wikiBody', 'bbBody', 'wikiImage', 'id', 'name', 'year', 'recordLabel', 'catalogueNumber',
+               'releaseType', 'categoryId', 'categoryName', 'time', 'collages', 'personalCollages', 'numComments',
+               'vanityHouse', 'isBookmarked', 'musicInfo', 'tags', 'torrents')
+    __slots__ = _fields
 
-class apiTorrentGroup():
     def __init__(self, **entries):
-        self.wikiBody = None
-        self.bbBody = None
-        self.wikiImage = None
-        self.id = None
-        self.name = None
-        self.year = None
-        self.recordLabel = None
-        self.catalogueNumber = None
-        self.releaseType = None
-        self.categoryId = None
-        self.categoryName = None
-        self.time = None
-        self.collages = []
-        self.personalCollages = []
-        self.numComments = None
-        self.vanityHouse = None
-        self.isBookmarked = None
-        self.musicInfo = {'composers': [],
-                          'dj': [],
-                          'artists': [],
-                          'with': [],
-                          'conductor': [],
-                          'remixedBy': [],
-                          'producer': []}
-        self.tags = []
-        self.torrents = []
-        self.__dict__.update(entries)
+        super().__init__(**entries)
+        if self.collages is None:
+            self.collages = []
+        if self.personalCollages is None:
+            self.personalCollages = []
+        if self.musicInfo is None:
+            self.musicInfo = {'composers': [],
+                              'dj': [],
+                              'artists': [],
+                              'with': [],
+                              'conductor': [],
+                              'remixedBy': [],
+                              'producer': []}
+        if self.tags is None:
+            self.tags = []
+        if self.torrents is None:
+            self.torrents = []
+
+    def fingerprint(self):
+        '''Short hash of the torrents (id, format, encoding) in the group, changes when one is added, deleted or edited'''
+        torrents = sorted((t.id, t.format, t.encoding) for t in self.torrents)
+        return hashlib.sha1(json.dumps(torrents).encode()).hexdigest()[:16]
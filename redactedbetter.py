@@ -1,22 +1,27 @@
 #!/usr/bin/env python3
 
+from collections import OrderedDict
 from configparser import ConfigParser
 import argparse
+import concurrent.futures
+import contextlib
 from pathlib import Path
 from typing import List, Optional
 import html.parser
 
 import shutil
+import signal
 import sys
 import tempfile
+import time
 import urllib.parse
 from multiprocessing import cpu_count
 import logging
 
 import tagging
 import transcode
-from redactedapi import RedactedAPI, apiTorrent, apiTorrentGroup
-from cache import Cache
+from redactedapi import AuthException, RedactedAPI, RequestException, apiTorrent, apiTorrentGroup, prefetch_torrentgroups, read_ahead
+from cache import BufferedCache, NotificationMark, Reason, ResponseCache, SeedingSnapshot, atomic_write, open_cache
 from static import Static
 
 st = Static()
@@ -24,11 +29,11 @@ st = Static()
 logger = logging.getLogger()
 
 
-def create_description(torrent, flac_dir, format, permalink):
+def create_description(torrent, probe, format, permalink):
     # Create an example command to document the transcode process.
     cmds = transcode.transcode_commands(format,
-                                        transcode.needs_resampling(flac_dir),
-                                        transcode.resample_rate(flac_dir),
+                                        transcode.needs_resampling(probe),
+                                        transcode.resample_rate(probe),
                                         'input.flac', 'output'
                                         + transcode.encoders[format]['ext'])
     description = '\n'.join([
@@ -78,6 +83,108 @@ def validate_spectrograms(flac_dir_str: str, threads: int) -> bool:
     return True
 
 
+def group_candidates(candidates, window):
+    '''
+    Reorders (groupid, torrentid) pairs so that, within every window of pairs, all torrents
+    of one group follow each other. Together with the api's torrent group LRU each group is
+    then fetched once and all its torrents are evaluated in the same pass.
+    '''
+    groups = OrderedDict()
+    count = 0
+    for groupid, torrentid in candidates:
+        groups.setdefault(groupid, []).append(torrentid)
+        count += 1
+        if count >= window:
+            for group, torrentids in groups.items():
+                for torrent in torrentids:
+                    yield group, torrent
+            groups.clear()
+            count = 0
+    for group, torrentids in groups.items():
+        for torrent in torrentids:
+            yield group, torrent
+
+
+def group_changed(api, cache, groupid, torrentid, max_age):
+    '''
+    Returns True if the torrent group's fingerprint differs from the one stored for torrentid in the cache.
+    Fingerprints younger than max_age seconds are trusted without fetching the group. A changed
+    fingerprint is not stored, that happens once the torrent has been evaluated again.
+    '''
+    stored = cache.fingerprint(torrentid)
+    if stored is not None and time.time() - stored[1] < max_age:
+        return False
+    fingerprint = api.get_api_torrentgroup(groupid).fingerprint()
+    if stored is not None and stored[0] != fingerprint:
+        return True
+    cache.set_fingerprint(torrentid, fingerprint)
+    return False
+
+
+def sync_seeding(api, snapshot_path, full_walk_age=24 * 60 * 60):
+    '''
+    The current seeding list, fetched incrementally against the snapshot left by the previous
+    run and saved for the next one. Falls back to the old snapshot if the sync fails. Once the
+    last walk of the whole list (the mtime of <snapshot>.walked) is full_walk_age seconds old
+    the whole list is walked again, which drops removed torrents an incremental sync can miss.
+    '''
+    previous = SeedingSnapshot.load(snapshot_path) if snapshot_path.exists() else []
+    walked_path = snapshot_path.with_name(snapshot_path.name + '.walked')
+    full_walk = not previous or not walked_path.exists() or time.time() - walked_path.stat().st_mtime > full_walk_age
+    if full_walk and previous:
+        logger.info('Seeding snapshot is due for a full walk')
+    current = api.sync_seeding([] if full_walk else previous)
+    if current is None:
+        logger.warning('Could not sync the seeding list, using the previous snapshot')
+        return previous
+    known = {torrentid for _, torrentid in previous}
+    seeding = {torrentid for _, torrentid in current}
+    logger.info(f'Seeding list synced: {len(seeding - known)} new, {len(known - seeding)} removed, {len(seeding)} seeding')
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(snapshot_path, SeedingSnapshot.dump(current))
+    if full_walk:
+        walked_path.touch()
+    return current
+
+
+def notification_candidates(api, cache, state_path, snapshot_path, max_pages, pending_age):
+    '''
+    (groupid, torrentid) pairs of FLACs announced in the notifications feed since the last run
+    that we seed. The feed is read newest first down to the persisted high-water mark; announced
+    torrents stay pending until the cache has a decision for them, so a run that is interrupted
+    hands its candidates to the next one. Those that are not seeding yet are looked at again for
+    pending_age seconds.
+    '''
+    state = NotificationMark.load(state_path)
+    now = time.time()
+    mark = state.mark
+    reached = False
+    for item in api.get_notifications(1, max_pages + 1):
+        torrentid = int(item['torrentId'])
+        if torrentid <= state.mark:
+            reached = True
+            break
+        mark = max(mark, torrentid)
+        if item.get('format') == 'FLAC':
+            state.pending.setdefault(torrentid, [int(item['groupId']), now])
+    if state.mark and not reached:
+        logger.warning(f'Read {max_pages} notification pages without reaching where the previous run '
+                       f'stopped, older notifications were not read. Raise --notification-pages or run --source seeding once')
+    seeding = {torrentid for _, torrentid in sync_seeding(api, snapshot_path)}
+    candidates = []
+    for torrentid, (groupid, first_seen) in sorted(state.pending.items(), reverse=True):
+        if torrentid in cache.ids:
+            del state.pending[torrentid]
+        elif torrentid in seeding:
+            candidates.append((groupid, torrentid))
+        elif now - first_seen > pending_age:
+            del state.pending[torrentid]
+    logger.info(f'{len(candidates)} FLACs from notifications to do, {len(state.pending) - len(candidates)} not seeding yet')
+    state.mark = mark
+    state.save(state_path)
+    return candidates
+
+
 def get_input(choices: List[str]) -> str:
     choice_set = set(choices)
     response = ''
@@ -130,18 +237,51 @@ def main():
     parser.add_argument('release_urls', nargs='*', help='the URL where the release is located')
     parser.add_argument('-s', '--single', action='store_true', help='only add one format per release (useful for getting unique groups)')
     parser.add_argument('-j', '--threads', type=int, help='number of threads to use when transcoding', default=max(cpu_count() - 1, 1))
+    parser.add_argument('--transcode-queue', type=int, default=4,
+                        help='Number of releases transcoding at once, the next candidate waits until one is uploaded')
     parser.add_argument('--config', help='the location of the configuration file', default=Path('~/.redactedbetter/config').expanduser())
-    parser.add_argument('--cache', help='the location of the cache', default=Path('~/.redactedbetter/cache').expanduser())
+    parser.add_argument('--cache', help='the location of the cache, a path ending in .sqlite or sqlite:<path> selects the SQLite store',
+                        default=Path('~/.redactedbetter/cache').expanduser())
+    parser.add_argument('--response-cache', help='where API responses are cached between runs, empty to disable',
+                        default=Path('~/.redactedbetter/responses.sqlite').expanduser())
+    parser.add_argument('--site', default='https://redacted.ch/',
+                        help='base url of the site, e.g. a local ajaxstandin.py (give it its own --response-cache)')
+    parser.add_argument('--stats-file', default=None,
+                        help='write per-action API call counts, latencies, rate limit waits and errors to this JSON file')
     parser.add_argument('-p', '--page-size', type=int, help='Number of snatched results to fetch at once', default=500)
+    parser.add_argument('--source', choices=['seeding', 'better', 'notifications'], default='seeding',
+                        help='where candidates come from: the whole seeding list, the site\'s list of torrents missing '
+                             'transcodes intersected with the seeding list, or FLACs from the notifications feed '
+                             'since the last run that are seeding')
+    parser.add_argument('--notification-state', help='where --source notifications keeps how far the feed was read',
+                        default=Path('~/.redactedbetter/notifications.json').expanduser())
+    parser.add_argument('--notification-pages', type=int, default=10,
+                        help='Most notification pages read in one run')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='only page through the seeding list until it reaches torrents already in the seeding snapshot')
+    parser.add_argument('--full-walk-age', type=float, default=24,
+                        help='Hours after which --incremental walks the whole seeding list again to drop removed torrents')
+    parser.add_argument('--seeding-snapshot', help='where the seeding list is kept between --incremental runs',
+                        default=Path('~/.redactedbetter/seeding').expanduser())
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help='Number of torrent groups to fetch ahead of the candidate being processed, 0 to disable')
     parser.add_argument('-f', '--force-format', default=None,  help='Force any of these formats: ''FLAC'', ''V0'', ''320''')
     parser.add_argument('--skip-missing', action='store_true', default=False, help='Skip snatches that have missing data directories')
     parser.add_argument('-r', '--retry', nargs='*', default=[], help='Retries certain classes of previous exit statuses')
     parser.add_argument('--skip-spectral', action='store_true', default=False, help='Skips spectrograph verification')
     parser.add_argument('--skip-hashcheck', action='store_true', default=False, help='Skip source file integrity verification')
     parser.add_argument('--no-upload', action='store_true', default=False, help='don\'t upload new torrents (in case you want to do it manually)')
+    parser.add_argument('--recheck', nargs='*', default=[],
+                        help='Re-evaluate cached torrents of these classes, but only if their group changed since it was last fetched')
+    parser.add_argument('--recheck-age', type=float, default=7 * 24,
+                        help='Hours before the group of a --recheck torrent is fetched again to compare its fingerprint')
+    parser.add_argument('--shared', action='store_true', default=False,
+                        help='claim candidates in the cache so several instances can share one cache and seeding list')
     parser.add_argument('-l', '--loglevel', default='INFO', help='Loglevel, options are: NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL')
 
     args = parser.parse_args()
+    if args.incremental and args.source != 'seeding':
+        parser.error('--incremental only applies to --source seeding')
 
     # loading configuration from config file, or create one at first pass
     config = parse_config(Path(args.config))
@@ -161,192 +301,71 @@ def main():
 
     do_24_bit = config.get('redacted', '24bit_behaviour')
 
-    api = RedactedAPI(args.page_size, api_key,)
+    # Turn SIGTERM into a normal exit, so the cache flushes what it buffered
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    # One worker pool for the whole run, started before any of the background threads
+    scheduler = transcode.TranscodeScheduler(args.threads)
 
-    cache = Cache(args.cache)
+    response_cache = ResponseCache(args.response_cache, account=api_key) if args.response_cache else None
+    api = RedactedAPI(args.page_size, api_key, response_cache=response_cache, mainpage=args.site)
+
+    cache = BufferedCache(open_cache(args.cache, 'torrent'))
 
     logger.info('Searching for transcode candidates...')
     if args.release_urls:
         logger.info('You supplied one or more release URLs, ignoring your configuration\'s media types.')
-        candidates = [(int(query['id']), int(query['torrentid'])) for query in
-                      [dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)) for url in args.release_urls]]
+        candidates = ((int(query['id']), int(query['torrentid'])) for query in
+                      [dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)) for url in args.release_urls])
+    elif args.source == 'better':
+        candidates = group_candidates(api.get_transcode_candidates(), args.page_size)
+    elif args.source == 'notifications':
+        candidates = group_candidates(notification_candidates(api, cache, Path(args.notification_state),
+                                                              Path(args.seeding_snapshot),
+                                                              args.notification_pages, 7 * 24 * 3600),
+                                      args.page_size)
+    elif args.incremental:
+        candidates = group_candidates(sync_seeding(api, Path(args.seeding_snapshot), args.full_walk_age * 60 * 60),
+                                      args.page_size)
     else:
-        candidates = api.get_seeding()
+        candidates = group_candidates(api.get_seeding(), args.page_size)
 
     # TODO: remove or fix retry modes, its broken now
     retry_modes = set(args.retry)
     logger.debug(retry_modes)
-
-    # Main loop that does all the transcoding, etc.
-    cache_count = 0
-    for groupid, torrentid in candidates:
-        logger.debug(torrentid)
-        # Test if torrent is in cache to reduce calls to server
-        if torrentid in cache.ids and not args.force_format:
-            retry = False
-            if cache.ids[torrentid] in retry_modes:
-                retry = True
-            if not retry:
-                logger.debug(f'Torrent ID {torrentid} present in cache. Skipping.')
-                cache_count += 1
-                continue
-
-        torrent_group = api.get_api_torrentgroup(groupid)
-
-        for torrent in torrent_group.torrents:
-            if torrent.id == torrentid:
-                api_torrent = torrent
-        logger.debug(f'{torrentid} type: {type(torrentid)} {api_torrent.id} type: {type(api_torrent.id)}')
-
-        # Test if torrent is flac
-        if "FLAC" not in api_torrent.format and "Lossless" not in api_torrent.encoding:
-            logger.info(f"Torrent {api.permalink(torrentid)} is not in flac format, transcode not possible")
-            cache.add(torrentid, 'no flac')
-            continue
-
-        # Check for scene release: must be manually descened, so not supported
-        if api_torrent.scene:
-            logger.info(f"Torrent {api.permalink(torrentid)} is a scene release, must be manually descened")
-            cache.add(torrentid, 'scene')
-            continue
-
-        # Check if torrent is trumpable, if so, it can only be uploaded if it is put in manually
-        if api_torrent.trumpable and not args.release_urls:
-            logger.info(f"Torrent {api.permalink(torrentid)} torrent is marked as trumpable, this will only be transcoded if added manually")
-            cache.add(torrentid, 'trumpable')
-            continue
-
-        # Create infoblock
-        artist = ""
-        if len(torrent_group.musicInfo['artists']) > 1:
-            artist = "Various Artists"
-        else:
-            artist = torrent_group.musicInfo['artists'][0]['name']
-
-        year = str(api_torrent.remasterYear)
-        if year == "0":
-            year = str(torrent_group.year)
-
-        releaseartist = f'Release artist(s): {html.unescape(artist)}'
-        releasename = f'Release name     : {html.unescape(torrent_group.name)}'
-        releaseyear = f'Release year     : {year}'
-        releaseurl = f'Release URL      : {api.release_url(torrent_group.id, api_torrent.id)}'
-
-        logger.info(border_msg(releaseartist
-                               + "\n" + releasename
-                               + "\n" + releaseyear
-                               + "\n" + releaseurl))
-
-        # Test if torrent is in it's own folder, if not, create one
-        if not api_torrent.filePath:
-            file_name = html.unescape(api_torrent.fileList)[0][0]
-            # find correct data_dir
-            data_dir = ''
-            for path in data_dirs:
-                flac_file = Path(path, file_name)
-                if flac_file.exists():
-                    data_dir = path
-            if data_dir == '':
-                logger.info(f"Path not found - skipping: {file_name}")
-                continue
-            # Flac folder name convention: Release Name (year) [FLAC]
-            flac_dir = Path(data_dir, f'{html.unescape(torrent_group.name)} ({torrent_group.year}) [FLAC]')
-            if not flac_dir.exists():
-                flac_dir.mkdir()
-            shutil.copy(flac_file, flac_dir)
-        else:
-            file_name = html.unescape(api_torrent.fileList)[0][0]
-            data_dir = ''
-            # find correct data_dir
-            for path in data_dirs:
-                flac_file = Path(path, html.unescape(api_torrent.filePath), file_name)
-                if flac_file.exists():
-                    data_dir = path
-            if data_dir == '':
-                logger.info(f'Path not found - skipping: {file_name}')
-                continue
-            flac_dir = Path(data_dir, html.unescape(api_torrent.filePath))
-
-        # TODO: correct 24bit behaviour, its broken now
-        if do_24_bit == 'yes':
-            try:
-                if transcode.is_24bit(flac_dir) and torrent['encoding'] != '24bit Lossless':
-                    # A lot of people are uploading FLACs from Bandcamp without realizing
-                    # that they're actually 24 bit files (usually 24/44.1). Since we know for
-                    # sure whether the files are 24 bit, we might as well correct the listing
-                    # on the site (and get an extra upload in the process).
-
-                    # TODO: check 24 bit behaviour
-                    if args.no_24bit_edit:
-                        logger.info("Release is actually 24-bit lossless, skipping.")
-                        continue
-                    if do_24_bit == 'yes':
-                        confirmation = input(
-                            "Mark release as 24bit lossless? y/n: ")
-                        if confirmation != 'y':
-                            continue
-                    logger.info("Marking release as 24bit lossless.")
-                    api.set_24bit(torrent)
-                    # group = api.request('torrentgroup', id=groupid)
-                    # torrent = [t for t in group['torrents']
-                    #            if t['id'] == torrentid][0]
-                    continue
-            except Exception as e:
-                logger.error(f'Can\'t edit 24-bit torrent - skipping: {e}')
-                continue
-
-        if transcode.is_multichannel(flac_dir):
-            logger.info("This is a multichannel release, which is unsupported - skipping")
-            continue
-
-        if args.force_format is not None:
-            needed = [args.force_format]  # manually declare which formats
-        else:
-            # needed = formats_needed(group, torrent, supported_formats)
-            needed = formats_needed(torrent_group, api_torrent, wanted_formats)
-
-        if len(needed) < 1:
-            logger.info("No transcode needed")
-            cache.add(torrentid, 'done')
-            continue
-        else:
-            logger.info(f'Formats needed: {", ".join(needed)}')
-
-        if needed:
-            # Before proceeding, do the basic tag checks on the source
-            # files to ensure any uploads won't be reported, but put
-            # on the tracknumber formatting; problems with tracknumber
-            # may be fixable when the tags are copied.
-            broken_tags = False
-            for flac_file in transcode.locate(flac_dir, transcode.ext_matcher('.flac')):
-                (ok, msg) = tagging.check_tags(flac_file, check_tracknumber_format=False)
-                if not ok:
-                    logger.info(f'A FLAC file in this release has unacceptable tags - skipping: {msg}'
-                                f'You might be able to trump it.')
-                    broken_tags = True
-                    break
-            if broken_tags:
-                continue
-
+    retry_ids = cache.with_reason(*retry_modes)
+    recheck_ids = cache.with_reason(*args.recheck)
+
+    if not args.release_urls:
+        # Keep the next seeding page and the groups of the next uncached candidates fetched in the background
+        candidates = read_ahead(candidates, 2 * args.page_size)
+        if args.prefetch > 0:
+            def wanted(groupid, torrentid):
+                if not (args.force_format or torrentid not in cache.ids or torrentid in retry_ids):
+                    return False
+                # Claim before fetching, so no rate limited call goes to a group another instance is doing.
+                # The main loop's claim of it then succeeds and it is released there if skipped
+                return not args.shared or cache.claim(torrentid, retry=bool(args.force_format) or torrentid in retry_ids)
+            # Candidates claimed ahead of the main loop are given back when it stops early
+            unwanted = (lambda groupid, torrentid: cache.release(torrentid)) if args.shared else None
+            candidates = prefetch_torrentgroups(api, candidates, wanted, args.prefetch, unwanted)
+
+    # Create and upload the torrents of a release once its transcodes are done
+    def finish_release(release, torrentid, torrent_group, api_torrent, probe, year, needed, mislabeled):
+        flac_dir = probe.flac_dir
+        try:
+            transcode_dirs = release.result()
+        except Exception as e:
+            logger.error(f'Transcoding torrent {torrentid} failed - skipping: {e}')
+            cache.add(torrentid, Reason.ERROR)
+            needed = []
         for format in needed:
             if Path(flac_dir).exists():
                 logger.info(f'Adding format {format}')
 
                 with tempfile.TemporaryDirectory() as tmpdir:
-                    if len(api_torrent.remasterTitle) >= 1:
-                        basename = html.unescape(artist) + " - " + html.unescape(torrent_group.name) + " (" + html.unescape(
-                            api_torrent.remasterTitle) + ") " + "(" + year + ") [" + api_torrent.media + " - "
-                    else:
-                        basename = html.unescape(artist) + " - " + html.unescape(torrent_group.name) + " (" + year + ") [" + api_torrent.media + " - "
-
-                    transcode_dir = transcode.transcode_release(
-                        flac_dir, output_dir, basename, format, max_threads=args.threads)
-                    if transcode_dir is False:
-                        logger.info('Skipping - some file(s) in this release were incorrectly marked as 24bit.')
-                        cache.add(torrentid, '24bit')
-                        break
-
-                    logger.info("Finished transcoding, creating torrent file")
+                    transcode_dir = transcode_dirs[format]
+                    logger.info("Creating torrent file")
 
                     new_torrent = transcode.make_torrent(
                         transcode_dir, tmpdir, api.tracker,
@@ -355,22 +374,30 @@ def main():
 
                     permalink = api.permalink(torrentid)
                     description = create_description(
-                        api_torrent, flac_dir, format, permalink)
+                        api_torrent, probe, format, permalink)
 
                     if not args.no_upload:
                         logger.info('Uploading torrent!')
                         shutil.copy(new_torrent, torrent_dir)
-                        response = api.upload(torrent_group, api_torrent, new_torrent, format, description)
+                        try:
+                            response = api.upload(torrent_group, api_torrent, new_torrent, format, description)
+                        except AuthException:
+                            raise
+                        except RequestException as e:
+                            # Only this release is lost, the others in the queue can still be uploaded
+                            logger.error(f'Uploading torrent {torrentid} failed - skipping the rest of it: {e}')
+                            cache.add(torrentid, Reason.ERROR, format)
+                            break
                         if response['status'] == 'success':
                             logger.info(f'New torrent uploaded: {api.permalink(response["response"]["torrentid"])}')
-                            cache.add(torrentid, 'done')
+                            cache.add(torrentid, Reason.DONE, format)
                         elif response['status'] == 'failure':
                             errorcode = response['error']
                             logger.error(f'An error occured while uploading:\n{errorcode}')
-                            cache.add(torrentid, 'no_upload')
+                            cache.add(torrentid, Reason.NO_UPLOAD, format)
                         else:
                             logger.error('Unknown error while uploading')
-                            cache.add(torrentid, 'error')
+                            cache.add(torrentid, Reason.ERROR, format)
                         # shutil.copy(new_torrent, torrent_dir)
                     else:
                         logger.info('\nTorrent ready for manual upload!')
@@ -381,7 +408,7 @@ def main():
                             logger.info(file_name)
                         logger.info('Upload info:')
                         logger.info(f'FLAC URL: {permalink}')
-                        logger.info(f'Edition: {year} - {torrent["remasterRecordLabel"]}')
+                        logger.info(f'Edition: {year} - {api_torrent.remasterRecordLabel}')
                         logger.info(f'Format: {format}')
                         logger.info('Description:')
                         logger.info(f'{description}\n')
@@ -394,9 +421,253 @@ def main():
                             pass
                     if args.single:
                         break
-                    cache.add(torrentid, 'done')
+                    cache.add(torrentid, Reason.DONE, format)
+        if mislabeled:
+            logger.info('Skipping - some file(s) in this release were incorrectly marked as 24bit.')
+            cache.add(torrentid, Reason.BIT24, 'FLAC')
+        cache.set_fingerprint(torrentid, torrent_group.fingerprint())
+        if args.shared:
+            cache.release(torrentid)
+
+    # Finish the releases whose transcodes are done, first waiting for one if the queue is full
+    def finish_releases(wait):
+        if wait and transcoding:
+            concurrent.futures.wait(transcoding, return_when=concurrent.futures.FIRST_COMPLETED)
+        for release in [release for release in transcoding if release.done()]:
+            finish_release(release, *transcoding.pop(release))
+
+    # Main loop that does all the transcoding, etc.
+    transcoding = OrderedDict()
+    cache_count = 0
+    claimed = None
+    evaluated = None
+    # Any error or Ctrl-C kills the workers and removes the output of the unfinished releases
+    with scheduler, contextlib.closing(candidates):
+        for groupid, torrentid in candidates:
+            # Upload the releases that finished transcoding while the previous candidate was evaluated
+            finish_releases(wait=False)
+            # Hand back a candidate that was skipped without a decision, another instance may be able to do it
+            if claimed is not None:
+                cache.release(claimed)
+                claimed = None
+            # The previous candidate has been evaluated, --recheck compares against the group it saw
+            if evaluated is not None:
+                cache.set_fingerprint(*evaluated)
+                evaluated = None
+            logger.debug(torrentid)
+            # Test if torrent is in cache to reduce calls to server
+            retry = False
+            if torrentid in cache.ids and not args.force_format:
+                if torrentid in recheck_ids and torrentid not in retry_ids:
+                    if not group_changed(api, cache, groupid, torrentid, args.recheck_age * 60 * 60):
+                        logger.debug(f'Torrent ID {torrentid} present in cache and its group is unchanged. Skipping.')
+                        cache_count += 1
+                        continue
+                    logger.info(f'Group {groupid} changed since torrent {torrentid} was cached, re-evaluating')
+                elif torrentid not in retry_ids:
+                    logger.debug(f'Torrent ID {torrentid} present in cache. Skipping.')
+                    cache_count += 1
+                    continue
+                retry = True
+
+            if args.shared:
+                if not cache.claim(torrentid, retry=retry or bool(args.force_format)):
+                    logger.debug(f'Torrent ID {torrentid} is done or claimed by another instance. Skipping.')
+                    continue
+                claimed = torrentid
+
+            torrent_group = api.get_api_torrentgroup(groupid)
+            evaluated = (torrentid, torrent_group.fingerprint())
+
+            for torrent in torrent_group.torrents:
+                if torrent.id == torrentid:
+                    api_torrent = torrent
+            logger.debug(f'{torrentid} type: {type(torrentid)} {api_torrent.id} type: {type(api_torrent.id)}')
+
+            # Test if torrent is flac
+            if "FLAC" not in api_torrent.format and "Lossless" not in api_torrent.encoding:
+                logger.info(f"Torrent {api.permalink(torrentid)} is not in flac format, transcode not possible")
+                cache.add(torrentid, Reason.NO_FLAC)
+                continue
+
+            # Check for scene release: must be manually descened, so not supported
+            if api_torrent.scene:
+                logger.info(f"Torrent {api.permalink(torrentid)} is a scene release, must be manually descened")
+                cache.add(torrentid, Reason.SCENE)
+                continue
+
+            # Check if torrent is trumpable, if so, it can only be uploaded if it is put in manually
+            if api_torrent.trumpable and not args.release_urls:
+                logger.info(f"Torrent {api.permalink(torrentid)} torrent is marked as trumpable, this will only be transcoded if added manually")
+                cache.add(torrentid, Reason.TRUMPABLE)
+                continue
+
+            # Create infoblock
+            artist = ""
+            if len(torrent_group.musicInfo['artists']) > 1:
+                artist = "Various Artists"
+            else:
+                artist = torrent_group.musicInfo['artists'][0]['name']
+
+            year = str(api_torrent.remasterYear)
+            if year == "0":
+                year = str(torrent_group.year)
+
+            releaseartist = f'Release artist(s): {html.unescape(artist)}'
+            releasename = f'Release name     : {html.unescape(torrent_group.name)}'
+            releaseyear = f'Release year     : {year}'
+            releaseurl = f'Release URL      : {api.release_url(torrent_group.id, api_torrent.id)}'
+
+            logger.info(border_msg(releaseartist
+                                   + "\n" + releasename
+                                   + "\n" + releaseyear
+                                   + "\n" + releaseurl))
+
+            # Test if torrent is in it's own folder, if not, create one
+            if not api_torrent.filePath:
+                file_name = html.unescape(api_torrent.fileList)[0][0]
+                # find correct data_dir
+                data_dir = ''
+                for path in data_dirs:
+                    flac_file = Path(path, file_name)
+                    if flac_file.exists():
+                        data_dir = path
+                if data_dir == '':
+                    logger.info(f"Path not found - skipping: {file_name}")
+                    continue
+                # Flac folder name convention: Release Name (year) [FLAC]
+                flac_dir = Path(data_dir, f'{html.unescape(torrent_group.name)} ({torrent_group.year}) [FLAC]')
+                if not flac_dir.exists():
+                    flac_dir.mkdir()
+                shutil.copy(flac_file, flac_dir)
+            else:
+                file_name = html.unescape(api_torrent.fileList)[0][0]
+                data_dir = ''
+                # find correct data_dir
+                for path in data_dirs:
+                    flac_file = Path(path, html.unescape(api_torrent.filePath), file_name)
+                    if flac_file.exists():
+                        data_dir = path
+                if data_dir == '':
+                    logger.info(f'Path not found - skipping: {file_name}')
+                    continue
+                flac_dir = Path(data_dir, html.unescape(api_torrent.filePath))
+
+            # Every FLAC is read once here, the checks below and the transcode all use the probe
+            try:
+                probe = transcode.ReleaseProbe.scan(flac_dir)
+            except Exception as e:
+                logger.info(f'Can\'t read the FLAC files - skipping: {e}')
+                cache.add(torrentid, Reason.ERROR)
+                continue
+
+            # TODO: correct 24bit behaviour, its broken now
+            if do_24_bit == 'yes':
+                try:
+                    if transcode.is_24bit(probe) and torrent['encoding'] != '24bit Lossless':
+                        # A lot of people are uploading FLACs from Bandcamp without realizing
+                        # that they're actually 24 bit files (usually 24/44.1). Since we know for
+                        # sure whether the files are 24 bit, we might as well correct the listing
+                        # on the site (and get an extra upload in the process).
+
+                        # TODO: check 24 bit behaviour
+                        if args.no_24bit_edit:
+                            logger.info("Release is actually 24-bit lossless, skipping.")
+                            continue
+                        if do_24_bit == 'yes':
+                            confirmation = input(
+                                "Mark release as 24bit lossless? y/n: ")
+                            if confirmation != 'y':
+                                continue
+                        logger.info("Marking release as 24bit lossless.")
+                        api.set_24bit(torrent)
+                        # group = api.request('torrentgroup', id=groupid)
+                        # torrent = [t for t in group['torrents']
+                        #            if t['id'] == torrentid][0]
+                        continue
+                except Exception as e:
+                    logger.error(f'Can\'t edit 24-bit torrent - skipping: {e}')
+                    continue
+
+            if transcode.is_multichannel(probe):
+                logger.info("This is a multichannel release, which is unsupported - skipping")
+                continue
+
+            if args.force_format is not None:
+                needed = [args.force_format]  # manually declare which formats
+            else:
+                # needed = formats_needed(group, torrent, supported_formats)
+                needed = formats_needed(torrent_group, api_torrent, wanted_formats)
+
+            if len(needed) < 1:
+                logger.info("No transcode needed")
+                cache.add(torrentid, Reason.DONE)
+                continue
+            else:
+                logger.info(f'Formats needed: {", ".join(needed)}')
+
+            if needed:
+                # Before proceeding, do the basic tag checks on the source
+                # files to ensure any uploads won't be reported, but put
+                # on the tracknumber formatting; problems with tracknumber
+                # may be fixable when the tags are copied.
+                broken_tags = False
+                for flac_info in probe:
+                    (ok, msg) = tagging.check_tags(flac_info.path, check_tracknumber_format=False)
+                    if not ok:
+                        logger.info(f'A FLAC file in this release has unacceptable tags - skipping: {msg}'
+                                    f'You might be able to trump it.')
+                        broken_tags = True
+                        break
+                if broken_tags:
+                    continue
 
+            if args.single:
+                needed = needed[:1]
+            # FLAC is only transcoded from 24 bit sources, a 16 bit one means the release is labelled wrong
+            mislabeled = 'FLAC' in needed and not transcode.needs_resampling(probe)
+            if mislabeled:
+                needed = needed[:needed.index('FLAC')]
+
+            if len(api_torrent.remasterTitle) >= 1:
+                basename = html.unescape(artist) + " - " + html.unescape(torrent_group.name) + " (" + html.unescape(
+                    api_torrent.remasterTitle) + ") " + "(" + year + ") [" + api_torrent.media + " - "
+            else:
+                basename = html.unescape(artist) + " - " + html.unescape(torrent_group.name) + " (" + year + ") [" + api_torrent.media + " - "
+
+            # Every file is decoded once for all needed formats, the files join the queue of the
+            # releases before it and the torrents are made when the last one is done
+            if needed:
+                logger.info(f'Transcoding to {", ".join(needed)}')
+                try:
+                    release = scheduler.submit(probe, output_dir, basename, needed)
+                except transcode.TranscodeException as e:
+                    logger.error(f'Can\'t transcode torrent {torrentid} - skipping: {e}')
+                    cache.add(torrentid, Reason.ERROR)
+                    continue
+            else:
+                release = concurrent.futures.Future()
+                release.set_result({})
+            transcoding[release] = (torrentid, torrent_group, api_torrent, probe, year, needed, mislabeled)
+            # The claim is held and the fingerprint stored when the release is uploaded
+            claimed = None
+            evaluated = None
+            finish_releases(wait=len(transcoding) >= args.transcode_queue)
+
+        while transcoding:
+            finish_releases(wait=True)
+    if claimed is not None:
+        cache.release(claimed)
+    if evaluated is not None:
+        cache.set_fingerprint(*evaluated)
+    cache.close()
+    if response_cache is not None:
+        response_cache.close()
     logger.info(f'Skipped {cache_count} torrents in cache')
+    logger.info(f'Waited {api.limiter.waited:.1f}s for the API rate limit ({api.limiter.waits} delayed requests)')
+    logger.info(api.stats.report())
+    if args.stats_file:
+        api.stats.dump(args.stats_file)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
 import errno
 import multiprocessing
 import os
@@ -10,6 +12,8 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 from html.parser import HTMLParser
 # import unidecode
 
@@ -79,6 +83,50 @@ def run_pipeline(cmds):
     return results
 
 
+def run_fanout(decoder, encoders):
+    '''
+    Like run_pipeline for one decoder feeding several encoders at once: the decoder's output is
+    read once and copied to the stdin of every encoder. Returns (code, stderr) for the decoder
+    followed by one pair per encoder. stderr goes to temporary files, so a chatty encoder can't
+    fill its pipe and stall the copy.
+    '''
+    sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    stderrs = [tempfile.TemporaryFile() for _ in range(len(encoders) + 1)]
+    try:
+        decoder_proc = subprocess.Popen(shlex.split(decoder), stdout=subprocess.PIPE, stderr=stderrs[0])
+        encoder_procs = [subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                          stderr=stderr) for cmd, stderr in zip(encoders, stderrs[1:])]
+    finally:
+        signal.signal(signal.SIGPIPE, sigpipe_handler)
+
+    running = list(encoder_procs)
+    while running:
+        chunk = decoder_proc.stdout.read(1 << 16)
+        if not chunk:
+            break
+        for proc in list(running):
+            try:
+                proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # The encoder died, its return code tells why
+                running.remove(proc)
+    for proc in encoder_procs:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    # Closing our end sends the decoder SIGPIPE if every encoder died early
+    decoder_proc.stdout.close()
+
+    results = []
+    for proc, stderr in zip([decoder_proc] + encoder_procs, stderrs):
+        proc.wait()
+        stderr.seek(0)
+        results.append((proc.returncode, stderr.read()))
+        stderr.close()
+    return results
+
+
 def locate(root, match_function, ignore_dotfiles=True):
     '''
     Yields all filenames within the root directory for which match_function returns True.
@@ -98,12 +146,90 @@ def ext_matcher(*extensions):
     return lambda f: os.path.splitext(f)[-1].lower() in extensions
 
 
+# Stream info of one FLAC file, the fields are named after mutagen's StreamInfo
+FlacInfo = collections.namedtuple('FlacInfo', ['path', 'sample_rate', 'bits_per_sample', 'channels', 'length',
+                                               'size', 'md5_signature'])
+
+
+def read_streaminfo(flac_file):
+    '''
+    Returns the FlacInfo of a FLAC file read from the fLaC marker and
+    the STREAMINFO block that must follow it, without parsing the rest
+    of the metadata (cover art can be megabytes). Returns None if the
+    file doesn't start the way the spec says, e.g. with an ID3 tag in
+    front, so the caller can fall back to mutagen.
+    '''
+    with open(flac_file, 'rb', buffering=0) as f:
+        header = f.read(42)
+        size = os.fstat(f.fileno()).st_size
+    # marker, block type 0 (last block flag aside) and a 34 byte length
+    if len(header) < 42 or header[:4] != b'fLaC' or header[4] & 0x7f != 0 or header[5:8] != b'\x00\x00\x22':
+        return None
+    # sample rate (20 bits), channels - 1 (3), bits per sample - 1 (5), total samples (36)
+    packed = int.from_bytes(header[18:26], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & 0xfffffffff
+    if not sample_rate or not total_samples:
+        return None
+    return FlacInfo(flac_file, sample_rate, ((packed >> 36) & 0x1f) + 1, ((packed >> 41) & 0x7) + 1,
+                    total_samples / sample_rate, size, int.from_bytes(header[26:42], 'big'))
+
+
+def read_flac_info(flac_file):
+    '''
+    Returns the FlacInfo of a FLAC file.
+    '''
+    flac_info = read_streaminfo(flac_file)
+    if flac_info is not None:
+        return flac_info
+    info = mutagen.flac.FLAC(flac_file).info
+    return FlacInfo(flac_file, info.sample_rate, info.bits_per_sample, info.channels, info.length,
+                    os.path.getsize(flac_file), info.md5_signature)
+
+
+class ReleaseProbe:
+    '''
+    The FlacInfo of every FLAC in a release, read in one scan of its
+    directory. The checks below and the transcode take either a
+    directory or a ReleaseProbe, so a release that is probed once is
+    never read again before its files are decoded.
+    '''
+    def __init__(self, flac_dir, files):
+        self.flac_dir = flac_dir
+        self.files = files
+
+    @classmethod
+    def scan(cls, flac_dir):
+        flac_dir = os.path.abspath(flac_dir)
+        return cls(flac_dir, [read_flac_info(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac'))])
+
+    @classmethod
+    def of(cls, flac_dir):
+        '''
+        Returns flac_dir if it is a ReleaseProbe already, else scans it.
+        '''
+        return flac_dir if isinstance(flac_dir, cls) else cls.scan(flac_dir)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def length(self):
+        return sum(info.length for info in self.files)
+
+    @property
+    def size(self):
+        return sum(info.size for info in self.files)
+
+
 def is_24bit(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is 24 bit.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.bits_per_sample > 16 for flac in flacs)
+    return any(info.bits_per_sample > 16 for info in ReleaseProbe.of(flac_dir))
 
 
 def is_multichannel(flac_dir):
@@ -111,8 +237,7 @@ def is_multichannel(flac_dir):
     Returns True if any FLAC within flac_dir is multichannel.
     '''
     try:
-        flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-        return any(flac.info.channels > 2 for flac in flacs)
+        return any(info.channels > 2 for info in ReleaseProbe.of(flac_dir))
     except:   # TODO: Rewrite to if-then-else
         return False
 
@@ -129,8 +254,7 @@ def resample_rate(flac_dir):
     '''
     Returns the rate to which the release should be resampled.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    original_rate = max(flac.info.sample_rate for flac in flacs)
+    original_rate = max(info.sample_rate for info in ReleaseProbe.of(flac_dir))
     if original_rate % 44100 == 0:
         return 44100
     elif original_rate % 48000 == 0:
@@ -139,43 +263,55 @@ def resample_rate(flac_dir):
         return None
 
 
-def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
+def decode_command(resample, needed_sample_rate, flac_file):
     '''
-    Return a list of transcode steps (one command per list element),
-    which can be used to create a transcode pipeline for flac_file ->
-    transcode_file using the specified output_format, plus any
-    resampling, if needed.
+    Return the command that decodes flac_file to a 16 bit wav stream on
+    stdout, resampling it if needed.
     '''
-
     if resample:
         flac_decoder = 'sox %(FLAC)s -G -b 16 -t wav - rate -v -L %(SAMPLERATE)s dither'
     else:
         flac_decoder = 'flac -dcs -- %(FLAC)s'
+    return flac_decoder % {'FLAC': pipes.quote(flac_file), 'SAMPLERATE': needed_sample_rate}
 
-    lame_encoder = 'lame -S %(OPTS)s - %(FILE)s'
-    flac_encoder = 'flac %(OPTS)s -o %(FILE)s -'
-
-    transcoding_steps = [flac_decoder]
 
+def encode_command(output_format, transcode_file):
+    '''
+    Return the command that encodes a wav stream on stdin to
+    transcode_file in output_format.
+    '''
     if encoders[output_format]['enc'] == 'lame':
-        transcoding_steps.append(lame_encoder)
+        encoder = 'lame -S %(OPTS)s - %(FILE)s'
     elif encoders[output_format]['enc'] == 'flac':
-        transcoding_steps.append(flac_encoder)
+        encoder = 'flac %(OPTS)s -o %(FILE)s -'
+    return encoder % {'FILE': pipes.quote(transcode_file), 'OPTS': encoders[output_format]['opts']}
 
-    transcode_args = {
-        'FLAC': pipes.quote(flac_file),
-        'FILE': pipes.quote(transcode_file),
-        'OPTS': encoders[output_format]['opts'],
-        'SAMPLERATE': needed_sample_rate,
-    }
 
+def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
+    '''
+    Return a list of transcode steps (one command per list element),
+    which can be used to create a transcode pipeline for flac_file ->
+    transcode_file using the specified output_format, plus any
+    resampling, if needed.
+    '''
     # https://redacted.ch/forums.php?action=viewthread&threadid=5749&postid=128454#post128454 suggests
     # sox -S "source.flac" -b 16 -G "target.flac" rate -v -L [44100/48000] dither -s -f low-shibata
     if output_format == 'FLAC' and resample:
-        commands = ['sox %(FLAC)s -G -b 16 %(FILE)s rate -v -L %(SAMPLERATE)s dither' % transcode_args]
-    else:
-        commands = [cmd % transcode_args for cmd in transcoding_steps]
-    return commands
+        return ['sox %(FLAC)s -G -b 16 %(FILE)s rate -v -L %(SAMPLERATE)s dither' % {
+            'FLAC': pipes.quote(flac_file), 'FILE': pipes.quote(transcode_file), 'SAMPLERATE': needed_sample_rate}]
+    return [decode_command(resample, needed_sample_rate, flac_file), encode_command(output_format, transcode_file)]
+
+
+def job_length(flac_info):
+    '''
+    What the files of a release are ordered by, longest first: the
+    duration, scaled by the sample rate for a file that is resampled as
+    sox works through every source sample. All files of a release go to
+    the same formats, so the encoders don't change the order.
+    '''
+    if flac_info.sample_rate > 48000 or flac_info.bits_per_sample > 16:
+        return flac_info.length * flac_info.sample_rate / 44100
+    return flac_info.length
 
 
 # Pool.map() can't pickle lambdas, so we need a helper function.
@@ -184,14 +320,51 @@ def pool_transcode(xxx_todo_changeme):
     return transcode(flac_file, output_dir, output_format)
 
 
+def pool_transcode_formats(job):
+    (flac_info, outputs) = job
+    return transcode_formats(flac_info.path, outputs, flac_info)
+
+
+def check_results(flac_file, commands, results):
+    '''
+    Raise TranscodeException if any process of a transcode failed.
+    '''
+    # Check for problems. Because it's a pipeline, the earliest one is
+    # usually the source. The exception is -SIGPIPE, which is caused
+    # by "backpressure" due to a later command failing: ignore those
+    # unless no other problem is found.
+    last_sigpipe = None
+    for (cmd, (code, stderr)) in zip(commands, results):
+        if code:
+            if code == -signal.SIGPIPE:
+                last_sigpipe = (cmd, (code, stderr))
+            else:
+                raise TranscodeException('Transcode of file "%s" failed: %s' % (flac_file, stderr))
+    if last_sigpipe:
+        # XXX: this should probably never happen....
+        raise TranscodeException('Transcode of file "%s" failed: SIGPIPE' % flac_file)
+
+
 def transcode(flac_file, output_dir, output_format):
     '''
     Transcodes a FLAC file into another format.
     '''
+    return transcode_formats(flac_file, {output_format: output_dir})[output_format]
+
+
+def transcode_formats(flac_file, outputs, flac_info=None):
+    '''
+    Transcodes a FLAC file into several formats at once, outputs maps
+    each format to its output directory. The file is decoded (and
+    resampled) once and the stream is fed to all encoders together.
+    flac_info is the file's FlacInfo if it was probed already.
+    Returns a dict of format to transcoded file.
+    '''
     # gather metadata from the flac file
-    flac_info = mutagen.flac.FLAC(flac_file)
-    sample_rate = flac_info.info.sample_rate
-    bits_per_sample = flac_info.info.bits_per_sample
+    if flac_info is None:
+        flac_info = read_flac_info(flac_file)
+    sample_rate = flac_info.sample_rate
+    bits_per_sample = flac_info.bits_per_sample
     resample = sample_rate > 48000 or bits_per_sample > 16
 
     # if resampling isn't needed then needed_sample_rate will not be used.
@@ -206,50 +379,46 @@ def transcode(flac_file, output_dir, output_format):
             raise UnknownSampleRateException(f'FLAC file "{flac_file}" has a sample rate {sample_rate}, which is not 88.2, 176.4 or'
                                              f'96kHz but needs resampling, this is unsupported')
 
-    if flac_info.info.channels > 2:
+    if flac_info.channels > 2:
         raise TranscodeDownmixException('FLAC file "%s" has more than 2 channels, unsupported' % flac_file)
 
-    # determine the new filename
+    # determine the new filenames
     transcode_basename = os.path.splitext(os.path.basename(flac_file))[0]
     transcode_basename = re.sub(r'[\?<>\\*\|"]', '_', transcode_basename)
-    transcode_file = os.path.join(output_dir, transcode_basename)
-    transcode_file += encoders[output_format]['ext']
-
-    if not os.path.exists(os.path.dirname(transcode_file)):
-        try:
-            os.makedirs(os.path.dirname(transcode_file))
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                # Harmless race condition -- another transcode process
-                # beat us here.
-                pass
-            else:
-                raise e
-
-    commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
-    results = run_pipeline(commands)
-
-    # Check for problems. Because it's a pipeline, the earliest one is
-    # usually the source. The exception is -SIGPIPE, which is caused
-    # by "backpressure" due to a later command failing: ignore those
-    # unless no other problem is found.
-    last_sigpipe = None
-    for (cmd, (code, stderr)) in zip(commands, results):
-        if code:
-            if code == -signal.SIGPIPE:
-                last_sigpipe = (cmd, (code, stderr))
-            else:
-                raise TranscodeException('Transcode of file "%s" failed: %s' % (flac_file, stderr))
-    if last_sigpipe:
-        # XXX: this should probably never happen....
-        raise TranscodeException('Transcode of file "%s" failed: SIGPIPE' % flac_file)
+    transcode_files = {}
+    for output_format, output_dir in outputs.items():
+        transcode_file = os.path.join(output_dir, transcode_basename)
+        transcode_file += encoders[output_format]['ext']
+        transcode_files[output_format] = transcode_file
+
+        if not os.path.exists(os.path.dirname(transcode_file)):
+            try:
+                os.makedirs(os.path.dirname(transcode_file))
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    # Harmless race condition -- another transcode process
+                    # beat us here.
+                    pass
+                else:
+                    raise e
+
+    if len(transcode_files) == 1:
+        [(output_format, transcode_file)] = transcode_files.items()
+        commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
+        results = run_pipeline(commands)
+    else:
+        commands = [decode_command(resample, needed_sample_rate, flac_file)]
+        commands += [encode_command(output_format, transcode_file) for output_format, transcode_file in transcode_files.items()]
+        results = run_fanout(commands[0], commands[1:])
+    check_results(flac_file, commands, results)
 
-    tagging.copy_tags(flac_file, transcode_file)
-    (ok, msg) = tagging.check_tags(transcode_file)
-    if not ok:
-        raise TranscodeException('Tag check failed on transcoded file: %s' % msg)
+    for transcode_file in transcode_files.values():
+        tagging.copy_tags(flac_file, transcode_file)
+        (ok, msg) = tagging.check_tags(transcode_file)
+        if not ok:
+            raise TranscodeException('Tag check failed on transcoded file: %s' % msg)
 
-    return transcode_file
+    return transcode_files
 
 
 def path_length_exceeds_limit(flac_dir, basename):
@@ -299,89 +468,193 @@ def transcode_release(flac_dir, output_dir, basename, output_format, max_threads
     '''
     Transcode a FLAC release into another format.
     '''
-    flac_dir = os.path.abspath(flac_dir)
-    output_dir = os.path.abspath(output_dir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    return transcode_release_formats(flac_dir, output_dir, basename, [output_format], max_threads)[output_format]
 
-    # check if we need to resample
-    resample = needs_resampling(flac_dir)
 
-    # check if we need to encode
-    if output_format == 'FLAC' and not resample:
-        return False
+def transcode_release_formats(flac_dir, output_dir, basename, output_formats, max_threads=None):
+    '''
+    Transcode a FLAC release into several formats in one pass, decoding
+    each file once for all of them. Returns a dict of format to
+    transcode directory, False for FLAC when the release doesn't need
+    resampling.
+    '''
+    with TranscodeScheduler(max_threads) as scheduler:
+        # Wait with a large timeout, as a workaround for a KeyboardInterrupt
+        # that would otherwise not be delivered while waiting. c.f.,
+        # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
+        return scheduler.submit(flac_dir, output_dir, basename, output_formats).result(60 * 60 * 12)
 
-    # make a new directory for the transcoded files
-    #
-    # NB: The cleanup code that follows this block assumes that
-    # transcode_dir is a new directory created exclusively for this
-    # transcode. Do not change this assumption without considering the
-    # consequences!
-    transcode_dir = get_transcode_dir(flac_dir, output_dir, basename, output_format, resample)
 
-    if not os.path.exists(transcode_dir):
-        os.makedirs(transcode_dir)
-    else:
-        raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
-
-    # To ensure that a terminated pool subprocess terminates its
-    # children, we make each pool subprocess a process group leader,
-    # and handle SIGTERM by killing the process group. This will
-    # ensure there are no lingering processes when a transcode fails
-    # or is interrupted.
-    def pool_initializer():
-        os.setsid()
-
-        def sigterm_handler(signum, frame):
-            # We're about to SIGTERM the group, including us; ignore
-            # it so we can finish this handler.
-            signal.signal(signal.SIGTERM, signal.SIG_IGN)
-            pgid = os.getpgid(0)
-            os.killpg(pgid, signal.SIGTERM)
-            sys.exit(-signal.SIGTERM)
-        signal.signal(signal.SIGTERM, sigterm_handler)
+# To ensure that a terminated pool subprocess terminates its
+# children, we make each pool subprocess a process group leader,
+# and handle SIGTERM by killing the process group. This will
+# ensure there are no lingering processes when a transcode fails
+# or is interrupted.
+def pool_initializer():
+    os.setsid()
 
-    try:
-        # create transcoding threads
-        #
-        # Use Pool.map() rather than Pool.apply_async() as it will raise
-        # exceptions synchronously. (Don't want to waste any more time
-        # when a transcode breaks.)
+    def sigterm_handler(signum, frame):
+        # We're about to SIGTERM the group, including us; ignore
+        # it so we can finish this handler.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        pgid = os.getpgid(0)
+        os.killpg(pgid, signal.SIGTERM)
+        sys.exit(-signal.SIGTERM)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+
+class TranscodeScheduler:
+    '''
+    One worker pool for a whole run. Releases are split into per-file
+    jobs that queue up behind the jobs of earlier releases, so workers
+    don't idle at the tail of a release and the pool is only forked
+    once. submit() returns a concurrent.futures.Future per release that
+    resolves to the dict transcode_release_formats() returns, as soon as
+    all files of that release are done.
+    '''
+    def __init__(self, max_threads=None):
+        self.pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
+        # Copying the extra files of a finished release happens here, not on the pool's result
+        # thread where it would hold up the callbacks of every other job
+        self._finisher = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='transcode-finish')
+        self._lock = threading.Lock()
+        # Output directories of releases that are not finished yet
+        self._unfinished = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def submit(self, flac_dir, output_dir, basename, output_formats):
+        '''
+        Queue the files of a FLAC release, a directory or its
+        ReleaseProbe, for transcoding into output_formats. Raises
+        TranscodeException right away if an output directory already
+        exists.
+        '''
+        probe = ReleaseProbe.of(flac_dir)
+        flac_dir = probe.flac_dir
+        output_dir = os.path.abspath(output_dir)
+        release = concurrent.futures.Future()
+
+        # check if we need to resample
+        resample = needs_resampling(probe)
+
+        # check if we need to encode
+        transcode_dirs = {output_format: False for output_format in output_formats}
+        output_formats = [output_format for output_format in output_formats if output_format != 'FLAC' or resample]
+        if not output_formats:
+            release.set_result(transcode_dirs)
+            return release
+
+        # make a new directory for the transcoded files of each format
         #
-        # XXX: actually, use Pool.map_async() and then get() the result
-        # with a large timeout, as a workaround for a KeyboardInterrupt in
-        # Pool.join(). c.f.,
-        # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
-        pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
+        # NB: The cleanup code in _finish() assumes that every
+        # transcode_dir is a new directory created exclusively for this
+        # transcode. Do not change this assumption without considering
+        # the consequences!
+        new_dirs = {output_format: get_transcode_dir(flac_dir, output_dir, basename, output_format, resample)
+                    for output_format in output_formats}
+        for transcode_dir in new_dirs.values():
+            if os.path.exists(transcode_dir):
+                raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+        for output_format, transcode_dir in new_dirs.items():
+            os.makedirs(transcode_dir)
+            transcode_dirs[output_format] = transcode_dir
+
+        jobs = [(flac_info, {output_format: os.path.dirname(flac_info.path).replace(flac_dir, new_dirs[output_format])
+                             for output_format in output_formats})
+                for flac_info in probe]
+        # Longest jobs first, so the release isn't left waiting on a long track that was started last
+        jobs.sort(key=lambda job: job_length(job[0]), reverse=True)
+        state = {'left': len(jobs), 'error': None}
+        with self._lock:
+            self._unfinished[release] = new_dirs
+
+        # Called from the pool's result thread for every finished file
+        def file_done(error=None):
+            with self._lock:
+                state['left'] -= 1
+                first_error = error is not None and state['error'] is None
+                if first_error:
+                    state['error'] = error
+                left = state['left']
+            if first_error:
+                # Fail the release right away, its directories are removed once the files in flight are done
+                self._resolve(release, error=error)
+            if left == 0:
+                self._finisher.submit(self._finish, release, flac_dir, new_dirs, transcode_dirs, state['error'])
+
+        if not jobs:
+            self._finish(release, flac_dir, new_dirs, transcode_dirs, None)
+        for job in jobs:
+            self.pool.apply_async(pool_transcode_formats, (job,), callback=lambda result: file_done(),
+                                  error_callback=file_done)
+        return release
+
+    def _finish(self, release, flac_dir, new_dirs, transcode_dirs, error):
+        with self._lock:
+            if self._unfinished.pop(release, None) is None:
+                # terminate() already cleaned up
+                return
+        if error is None:
+            try:
+                # copy other files
+                allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
+                allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
+                for filename in allowed_files:
+                    for transcode_dir in new_dirs.values():
+                        new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
+                        if not os.path.exists(new_dir):
+                            os.makedirs(new_dir)
+                        shutil.copy(filename, new_dir)
+            except Exception as e:
+                error = e
+        if error is not None:
+            # Cleanup.
+            #
+            # ASSERT: the new_dirs were created by submit() and do not
+            # contain anything other than the transcoded files!
+            for transcode_dir in new_dirs.values():
+                shutil.rmtree(transcode_dir, ignore_errors=True)
+        self._resolve(release, transcode_dirs, error)
+
+    @staticmethod
+    def _resolve(release, result=None, error=None):
         try:
-            result = pool.map_async(pool_transcode, [(filename, os.path.dirname(filename).replace(
-                flac_dir, transcode_dir), output_format) for filename in flac_files])
-            result.get(60 * 60 * 12)
-            pool.close()
-        except:
-            # TODO: rewrite to if-then-else
-            pool.terminate()
-            raise
-        finally:
-            pool.join()
-
-        # copy other files
-        allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
-        allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
-        for filename in allowed_files:
-            new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
-            if not os.path.exists(new_dir):
-                os.makedirs(new_dir)
-            shutil.copy(filename, new_dir)
-
-        return transcode_dir
-
-    except:
-        # Cleanup.
-        #
-        # ASSERT: transcode_dir was created by this function and does
-        # not contain anything other than the transcoded files!
-        shutil.rmtree(transcode_dir)
-        raise
+            if error is not None:
+                release.set_exception(error)
+            else:
+                release.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            # Already failed
+            pass
+
+    def close(self):
+        '''Wait for all queued files, then stop the workers'''
+        self.pool.close()
+        self.pool.join()
+        self._finisher.shutdown()
+
+    def terminate(self):
+        '''
+        Kill the workers and remove the output of every unfinished release,
+        whose futures fail with a TranscodeException.
+        '''
+        self.pool.terminate()
+        self.pool.join()
+        self._finisher.shutdown(cancel_futures=True)
+        with self._lock:
+            unfinished, self._unfinished = self._unfinished, {}
+        for release, new_dirs in unfinished.items():
+            for transcode_dir in new_dirs.values():
+                shutil.rmtree(transcode_dir, ignore_errors=True)
+            self._resolve(release, error=TranscodeException('transcoding was stopped'))
 
 
 def make_torrent(input_dir, output_dir, tracker, passkey, piece_length):
@@ -5,11 +5,12 @@
 from configparser import ConfigParser
 import argparse
 from pathlib import Path
+import signal
 import sys
 
 import html
 
-from cache import Cache
+from cache import BufferedCache, Reason, ResponseCache, open_cache
 import redactedapi
 import uchicago as uc
 from utils import Utilities
@@ -43,14 +44,31 @@ def main():
                         help='End page number, needs to be specified together with --page-range-from', default=None)
     parser.add_argument('-r', '--retry-all', action='store_true',
                         help='Ignore cached requests', default=False)
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Number of pages fetched at once, all within the API rate limit')
+    parser.add_argument('--unordered', action='store_true', default=False,
+                        help='Match requests from pages as they arrive instead of in page order')
+    parser.add_argument('--stop-after-cached', type=int, default=0,
+                        help='Stop once this many pages in a row hold only cached requests, 0 scans the whole range. '
+                             'Pages are then sorted newest first instead of by bounty, so new requests come before '
+                             'the ones a previous scan cached')
     parser.add_argument('-s', '--sparse', action='store_true',
                         help='Only print RequestIds', default=False)
-    parser.add_argument('--cache', help='the location of the cache',
+    parser.add_argument('--cache', help='the location of the cache, a path ending in .sqlite or sqlite:<path> selects the SQLite store',
                         default=Path('~/.redactedbetter/libchicagomatchrequestscache').expanduser())
+    parser.add_argument('--response-cache', help='where API responses are cached between runs, empty to disable',
+                        default=Path('~/.redactedbetter/responses.sqlite').expanduser())
+    parser.add_argument('--site', default='https://redacted.ch/',
+                        help='base url of the site, e.g. a local ajaxstandin.py (give it its own --response-cache)')
+    parser.add_argument('--stats-file', default=None,
+                        help='write per-action API call counts, latencies, rate limit waits and errors to this JSON file')
     parser.add_argument('--config', help='the location of the configuration file',
                         default=Path('~/.redactedbetter/config').expanduser())
 
     args = parser.parse_args()
+    if args.unordered and args.stop_after_cached:
+        # Out of order, a run of cached pages says nothing about the pages before them
+        parser.error('--stop-after-cached needs pages in order, it can\'t be used with --unordered')
 
     ut = Utilities()
 
@@ -75,50 +93,78 @@ def main():
     api_key = config.get('redacted', 'api_key')
 
     # print('Initializing with API key')
-    api = redactedapi.RedactedAPI(args.page_size, api_key, args.sparse)
+    response_cache = ResponseCache(args.response_cache, account=api_key) if args.response_cache else None
+    api = redactedapi.RedactedAPI(args.page_size, api_key, args.sparse, response_cache=response_cache,
+                                  mainpage=args.site)
 
-    cache = Cache(args.cache)
+    cache = BufferedCache(open_cache(args.cache, 'request'))
+
+    # Turn SIGTERM into a normal exit, so the cache flushes what it buffered
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
     # load requests and start processing them, the goal is to identify easily
     # fillable requests: transcodes: No MP3 requested
     cache_count = 0
-    for request in api.get_requests_historical(start_page=page_start,
-                                               end_page=page_end):
-
-        if request["requestId"] in cache.ids and not args.retry_all:
-            cache_count += 1
-            continue
-        artist = ''
-        albumtitle = ''
-
-        if request["artists"]:
-            artist = html.unescape(request["artists"][0][0]["name"])
-            albumtitle = html.unescape(request["title"])
-        else:
-            albumtitle = html.unescape(request["title"])
-            print(
-                f'****************************No artist name! https://redacted.ch/requests.php?action=view&id={request["requestId"]}')
-        # print(html.unescape(searchstring))
-        mwresult = uc.get_records(artist, albumtitle)
-        if not mwresult:
-            cache.add(request["requestId"], 'no match')
+    cached_pages = 0
+    last_page = page_start
+    # By bounty a new request can sit behind pages of cached ones, newest first it can't
+    order = 'created' if args.stop_after_cached else 'bounty'
+    pages = api.get_requests_historical_pages(page_start, page_end, args.concurrency, not args.unordered, order)
+    for page, results in pages:
+        last_page = max(last_page, page)
+        # A repeat scan has caught up with the previous one once pages hold nothing but cached requests
+        if not args.retry_all and all(request["requestId"] in cache.ids for request in results):
+            cache_count += len(results)
+            cached_pages += 1
+            if args.stop_after_cached and cached_pages >= args.stop_after_cached:
+                if not args.sparse:
+                    print(f'{cached_pages} pages in a row were all cached, stopping at page {page}')
+                pages.close()
+                break
             continue
-        bounty_pretty = ut.prettify_bytes(int(request["bounty"]))
-
-        print(f'########## Potential match! Bounty: {bounty_pretty}')
-        print(f'{artist} - {albumtitle} (https://redacted.ch/requests.php?action=view&id={request["requestId"]})')
-        print("+++")
-        if "Record" in mwresult:
-            print(mwresult)
-        else:
-            print(f'No Record, but a response: {mwresult}')
-        print("+++")
-        print('##########')
-        cache.add(request["requestId"], 'match')
+        cached_pages = 0
+        for request in results:
+            if request["requestId"] in cache.ids and not args.retry_all:
+                cache_count += 1
+                continue
+            artist = ''
+            albumtitle = ''
+
+            if request["artists"]:
+                artist = html.unescape(request["artists"][0][0]["name"])
+                albumtitle = html.unescape(request["title"])
+            else:
+                albumtitle = html.unescape(request["title"])
+                print(
+                    f'****************************No artist name! https://redacted.ch/requests.php?action=view&id={request["requestId"]}')
+            # print(html.unescape(searchstring))
+            mwresult = uc.get_records(artist, albumtitle)
+            if not mwresult:
+                cache.add(request["requestId"], Reason.NO_MATCH)
+                continue
+            bounty_pretty = ut.prettify_bytes(int(request["bounty"]))
+
+            print(f'########## Potential match! Bounty: {bounty_pretty}')
+            print(f'{artist} - {albumtitle} (https://redacted.ch/requests.php?action=view&id={request["requestId"]})')
+            print("+++")
+            if "Record" in mwresult:
+                print(mwresult)
+            else:
+                print(f'No Record, but a response: {mwresult}')
+            print("+++")
+            print('##########')
+            cache.add(request["requestId"], Reason.MATCH)
+    cache.close()
+    if response_cache is not None:
+        response_cache.close()
 
     if not args.sparse:
-        print(f'Searched pages {page_start} to {page_end}')
+        print(f'Searched pages {page_start} to {last_page}')
         print(f'Skipped {cache_count} cached requests')
+        print(f'Waited {api.limiter.waited:.1f}s for the API rate limit ({api.limiter.waits} delayed requests)')
+        print(api.stats.report())
+    if args.stats_file:
+        api.stats.dump(args.stats_file)
 
 
 if __name__ == "__main__":